@@ -0,0 +1,58 @@
+""" CPU latency and peak memory of a GPT2Model forward pass with the eager and the sdpa attention backends,
+    for sequence lengths 256, 512 and 1024, and the largest difference between their hidden states.
+
+    python -m benchmarks.attention --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+import multiprocessing
+import resource
+
+import torch
+
+from benchmarks.common import timed, set_seed
+from scripts.model import DistilGPT2LMHeadModel
+
+
+def run_forward(args, backend, seq_len):
+    """ Run in a fresh process: (last hidden states, seconds per forward, peak RSS growth in MB) """
+    torch.set_num_threads(args.num_threads)
+    model = DistilGPT2LMHeadModel.from_pretrained(args.model_name_or_path).eval()
+    model.transformer.set_attention_backend(backend)
+    set_seed(args.seed)
+    input_ids = torch.randint(0, model.config.vocab_size, (args.batch_size, seq_len))
+    with torch.no_grad():
+        model.transformer(input_ids, use_cache=False)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        seconds = 0.0
+        for _ in range(args.repeats):
+            outputs, elapsed = timed(lambda: model.transformer(input_ids, use_cache=False))
+            seconds += elapsed
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    return outputs[0], seconds / args.repeats, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, default="gpt2")
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    for seq_len in args.seq_lens:
+        results = {}
+        for backend in ("eager", "sdpa"):
+            # one process per run, so that the peak RSS of one run does not hide the next
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                results[backend] = pool.apply(run_forward, (args, backend, seq_len))
+        max_diff = (results["eager"][0] - results["sdpa"][0]).abs().max().item()
+        print("T=%4d: hidden states within %.2e" % (seq_len, max_diff))
+        for backend, (_, seconds, peak) in results.items():
+            print("  %-6s %8.1f ms/forward  peak RSS +%7.1f MB" % (backend, 1000 * seconds, peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+""" CPU throughput of run_batch_generation_batched for growing batch sizes on a test split.
+
+    python -m benchmarks.batched_generation --dataset camrest --model_name_or_path runs/uni-tod/camrest
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed, set_seed
+from scripts.model import run_batch_generation_batched
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--num_examples", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+
+    base = None
+    for batch_size in args.batch_sizes:
+        set_seed(args.seed)
+        seconds, n_tokens = 0.0, 0
+        with torch.no_grad():
+            for start in range(0, len(examples), batch_size):
+                outputs, elapsed = timed(run_batch_generation_batched, args, model, examples[start:start + batch_size], dataset)
+                seconds += elapsed
+                n_tokens += sum(len(output[0]) for output in outputs)
+        throughput = len(examples) / seconds
+        base = base or throughput
+        print("batch %3d: %7.2f responses/s  %8.1f tokens/s  speedup x%.2f" % (batch_size, throughput, n_tokens / seconds, throughput / base))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+""" Quality against latency of run_batch_generation_beam for beam widths 1-8 on a test split.
+
+    python -m benchmarks.beam_search --dataset incar --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed, score_responses
+from scripts.model import run_batch_generation_beam
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--beam_widths", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_examples", type=int, default=200)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+
+    print("%s/%s: %d turns, batches of %d" % (args.dataset, args.split, len(examples), args.batch_size))
+    for num_beams in args.beam_widths:
+        args.num_beams = num_beams
+        outputs, seconds = [], 0.0
+        with torch.no_grad():
+            for start in range(0, len(examples), args.batch_size):
+                batch_outputs, elapsed = timed(run_batch_generation_beam, args, model, examples[start:start + args.batch_size], dataset)
+                outputs.extend(batch_outputs)
+                seconds += elapsed
+        bleu, entity_f1 = score_responses(args, outputs)
+        print("beam %d: BLEU %.4f  Entity-F1 %.4f  %8.1f ms/response" % (
+            num_beams, bleu, entity_f1, 1000 * seconds / len(examples)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+""" fp32 against bf16 autocast on CPU: training steps/s and loss, generation tokens/s, BLEU and Entity-F1,
+    and the peak memory of each, every precision in its own process.
+
+    python -m benchmarks.bf16 --dataset incar --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+import multiprocessing
+import resource
+
+import torch
+
+from benchmarks.common import add_dataset_args, get_tokenizer, load_dataset, load_eval_setup, timed, set_seed, score_responses
+from scripts.model import run_batch_generation, run_batch_generation_sample
+
+
+def train_steps(args, model, dataset):
+    losses = []
+    model.train()
+    for i in range(args.train_steps):
+        batch = dataset.collate_fn([dataset[j] for j in range(i * args.batch_size, (i + 1) * args.batch_size)])
+        loss = run_batch_generation(args, model, batch)[0]
+        loss.backward()
+        model.zero_grad()
+        losses.append(loss.item())
+    model.eval()
+    return losses
+
+
+def generate_all(args, model, examples, dataset):
+    outputs = []
+    with torch.no_grad():
+        for i, example in enumerate(examples):
+            set_seed(args.seed + i)
+            outputs.append(run_batch_generation_sample(args, model, [example], dataset))
+    return outputs
+
+
+def run(args, bf16):
+    """ Run in a fresh process: the training losses and time, the generation outputs and time, peak RSS in MB """
+    model, dataset, examples = load_eval_setup(args)
+    args.bf16 = bf16
+    set_seed(args.seed)
+    losses, train_time = timed(train_steps, args, model, load_dataset(args, args.tokenizer, split="train"))
+    outputs, generation_time = timed(generate_all, args, model, examples, dataset)
+    return losses, train_time, outputs, generation_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--train_steps", type=int, default=10)
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, bf16 in (("fp32", False), ("bf16", True)):
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            results[name] = pool.apply(run, (args, bf16))
+
+    args.tokenizer = get_tokenizer(args)
+    print("%s: %d training steps of %d, %d test turns" % (args.dataset, args.train_steps, args.batch_size, args.num_examples))
+    for name, (losses, train_time, outputs, generation_time, peak) in results.items():
+        bleu, entity_f1 = score_responses(args, outputs)
+        n_tokens = sum(len(output[0]) for output in outputs)
+        print("%s: train %6.2f steps/s, mean loss %.4f | generate %7.1f tokens/s, BLEU %.4f, Entity-F1 %.4f | peak RSS %7.1f MB" % (
+            name, args.train_steps / train_time, sum(losses) / len(losses), n_tokens / generation_time, bleu, entity_f1, peak))
+    max_diff = max(abs(a - b) for a, b in zip(results["fp32"][0], results["bf16"][0]))
+    same = sum(a[0] == b[0] for a, b in zip(results["fp32"][2], results["bf16"][2]))
+    print("largest loss difference %.4f, %d/%d identical responses" % (max_diff, same, len(results["fp32"][2])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+""" Load a checkpoint that may still hold the per-layer causal-mask buffers, save it again without them
+    and compare the size and the load time of both.
+
+    python -m benchmarks.checkpoint --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+
+from benchmarks.common import timed
+from scripts.model import DistilGPT2LMHeadModel, LEGACY_ATTENTION_BUFFERS
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, default="gpt2")
+    args = parser.parse_args()
+
+    model, old_load = timed(DistilGPT2LMHeadModel.from_pretrained, args.model_name_or_path)
+    legacy = [key for key in model.state_dict() if key.rsplit(".", 1)[-1] in LEGACY_ATTENTION_BUFFERS and ".attn." in key]
+    assert not legacy, "the model still has causal-mask buffers: %s" % legacy[:2]
+
+    with tempfile.TemporaryDirectory() as path:
+        model.save_pretrained(path)
+        reloaded, new_load = timed(DistilGPT2LMHeadModel.from_pretrained, path)
+        size = directory_size(path)
+    for (name, old), new in zip(model.state_dict().items(), reloaded.state_dict().values()):
+        assert torch.equal(old, new), "%s differs after the round trip" % name
+
+    old_size = directory_size(args.model_name_or_path) if os.path.isdir(args.model_name_or_path) else None
+    print("loaded %s in %.2fs%s" % (args.model_name_or_path, old_load,
+                                     ", %.1f MB on disk" % (old_size / 2 ** 20) if old_size else ""))
+    print("saved again: %.1f MB on disk, loaded in %.2fs" % (size / 2 ** 20, new_load))
+
+
+if __name__ == "__main__":
+    main()
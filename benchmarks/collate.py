@@ -0,0 +1,57 @@
+""" Collate time per batch of the pad_ids collate_fn against TensorCollator, at batch sizes 4..64.
+
+    python -m benchmarks.collate --dataset camrest --split train
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from benchmarks.common import add_dataset_args, get_tokenizer, load_dataset, report
+from utils.dataset_utils import pad_ids, TensorCollator
+
+
+def pad_ids_collate(batch, pad):
+    # Dataset.collate_fn before TensorCollator, without the trie list
+    input_ids = [ins["input_ids"] for ins in batch]
+    token_type_ids = [ins["token_type_ids"] for ins in batch]
+    lm_labels = [ins["lm_labels"] for ins in batch]
+    pos_ids = [ins["pos_ids"] for ins in batch]
+
+    input_ids = torch.tensor(pad_ids(input_ids, pad))
+    token_type_ids = torch.tensor(pad_ids(token_type_ids, pad))
+    pos_ids = torch.tensor(pad_ids(pos_ids, pad))
+    lm_labels = torch.tensor(pad_ids(lm_labels, -100))
+    return input_ids, token_type_ids, pos_ids, lm_labels
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--n_batches", type=int, default=200)
+    parser.add_argument("--pin_memory", action="store_true")
+    args = parser.parse_args()
+    random.seed(42)
+
+    dataset = load_dataset(args, get_tokenizer(args))
+    instances = [dataset[i] for i in range(len(dataset))]
+    collator = TensorCollator(dataset.pad, pin_memory=args.pin_memory)
+    for batch_size in args.batch_sizes:
+        batches = [random.sample(instances, batch_size) for _ in range(args.n_batches)]
+        for batch in batches[:10]:
+            old, new = pad_ids_collate(batch, dataset.pad), collator(batch)
+            mask = torch.arange(old[0].shape[1]) < torch.tensor([len(ins["input_ids"]) for ins in batch])[:, None]
+            for i in (0, 1, 3):
+                assert torch.equal(old[i], new[i])
+            assert torch.equal(old[2][mask], new[2][mask])
+
+        for name, collate in [("pad_ids", lambda b: pad_ids_collate(b, dataset.pad)), ("TensorCollator", collator)]:
+            start = time.perf_counter()
+            for batch in batches:
+                collate(batch)
+            report("%s bs=%d" % (name, batch_size), time.perf_counter() - start, len(batches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import json
+import time
+
+import torch
+from transformers import GPT2Tokenizer
+
+from scripts.model import DistilGPT2LMHeadModel
+
+
+def add_dataset_args(parser):
+    parser.add_argument("--dataset", type=str, default="incar", choices=["incar", "camrest"])
+    parser.add_argument("--split", type=str, default="val")
+    parser.add_argument("--model_name_or_path", type=str, default="gpt2",
+                        help="Tokenizer (and model) to load, a fine-tuned checkpoint directory works too")
+    parser.add_argument("--params_file", type=str, default="config/gpt2/params.json")
+    parser.add_argument("--dataroot", type=str, default="data")
+    return parser
+
+
+def dataset_module(name):
+    if name == "incar":
+        from scripts import dataset_incar as module
+    else:
+        from scripts import dataset_camrest as module
+    return module
+
+
+def get_tokenizer(args):
+    module = dataset_module(args.dataset)
+    tokenizer = GPT2Tokenizer.from_pretrained(args.model_name_or_path)
+    tokenizer.add_special_tokens(module.SPECIAL_TOKENS)
+    return tokenizer
+
+
+def get_dataset_args(args):
+    with open(args.params_file) as f:
+        params = json.load(f)
+    dataset_args = argparse.Namespace(**params["dataset_args"])
+    dataset_args.dataroot = args.dataroot
+    return dataset_args
+
+
+def load_dataset(args, tokenizer, cls="Dataset", split=None):
+    module = dataset_module(args.dataset)
+    return getattr(module, cls)(get_dataset_args(args), tokenizer, args.dataset, split or args.split)
+
+
+def load_eval_setup(args):
+    """ The setup of the generation benchmarks: merge args.generation_params_file into args, load the tokenizer
+        (as args.tokenizer), the EvalDataset of the test split (for the default val) and the model on CPU.
+        Returns (model, dataset, the first args.num_examples examples).
+    """
+    args.split = "test" if args.split == "val" else args.split
+    with open(args.generation_params_file) as f:
+        vars(args).update(json.load(f))
+    args.device = "cpu"
+
+    args.tokenizer = get_tokenizer(args)
+    dataset = load_dataset(args, args.tokenizer, cls="EvalDataset")
+    model = DistilGPT2LMHeadModel.from_pretrained(args.model_name_or_path).to(args.device).eval()
+    examples = [dataset[i] for i in range(min(args.num_examples, len(dataset)))]
+    return model, dataset, examples
+
+
+def timed(fn, *inputs):
+    """ Run fn(*inputs) once and return (result, seconds) """
+    start = time.perf_counter()
+    result = fn(*inputs)
+    return result, time.perf_counter() - start
+
+
+def report(name, seconds, count, unit="batch"):
+    print("%-28s total %8.3fs  %8.3f ms/%s" % (name, seconds, 1000 * seconds / max(count, 1), unit))
+
+
+def set_seed(seed):
+    torch.manual_seed(seed)
+
+
+def score_responses(args, outputs):
+    """ (BLEU, Entity-F1) of run_batch_generation_sample outputs """
+    from utils.metrics import BLEU, EntityF1
+    bleu, entity_f1 = BLEU(args.dataset), EntityF1(args.dataset)
+    for output, response_text, _, ref_entities, knowledge_text, task in outputs:
+        hypothesis = args.tokenizer.decode(output, skip_special_tokens=True)
+        bleu.update((hypothesis, response_text, task))
+        entity_f1.update((hypothesis.split(), ref_entities, knowledge_text, task))
+    return bleu.compute(), entity_f1.compute()
@@ -0,0 +1,89 @@
+""" The exported decoder step (scripts/export.py) against the eager model on a test split: the logits of one
+    step after each prompt, then greedy responses and their time through each step.
+
+    python -m benchmarks.export --dataset incar --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed
+from scripts.export import (DecoderStep, OnnxDecoderStep, export_onnx, export_torchscript, kg_mask_weights,
+                            run_batch_generation_step, ONNX_NAME, TORCHSCRIPT_NAME)
+from scripts.model import KGMaskState, run_batch_generation_incremental, stack_kg_masks
+
+
+def step_inputs(args, model, example, dataset):
+    """ The inputs of the first step after the prompt of `example`, and the eager logits of that step """
+    trie = example["trie"]
+    instance, _ = dataset.build_input_from_segments(example["knowledge"], example["history"], [], trie, example,
+                                                    with_eos=False)
+    kg_state = KGMaskState(trie, instance["input_ids"])
+    input_ids = torch.tensor(instance["input_ids"], device=args.device).unsqueeze(0)
+    token_type_ids = torch.tensor(instance["token_type_ids"], device=args.device).unsqueeze(0)
+    logits, past = model(input_ids=input_ids, token_type_ids=token_type_ids, trie=[trie], use_cache=True)[:2]
+    prev = logits[0, -1].argmax().item()
+    kg_state.update(prev)
+    kg_mask = stack_kg_masks([kg_state.kg_mask()])
+    input_ids = torch.tensor([[prev]], device=args.device)
+    token_type_ids = torch.tensor([[instance["token_type_ids"][-1]]], device=args.device)
+    expected = model(input_ids=input_ids, token_type_ids=token_type_ids, past=past, kg_mask=kg_mask, use_cache=True)[0]
+    past = torch.stack(past)
+    inputs = (input_ids, token_type_ids, torch.tensor([[past.size(-2)]], device=args.device),
+              torch.ones(1, past.size(-2) + 1, dtype=torch.long, device=args.device), past,
+              kg_mask_weights(kg_mask, logits.size(-1)).to(args.device))
+    return inputs, expected[0, -1]
+
+
+def check_logits(args, model, steps, examples, dataset):
+    """ Largest difference to the eager logits, per step """
+    max_diff = dict.fromkeys(steps, 0.0)
+    for example in examples:
+        inputs, expected = step_inputs(args, model, example, dataset)
+        for name, step in steps.items():
+            logits, presents = step(*inputs)
+            assert presents.size(-2) == inputs[4].size(-2) + 1, "%s returned a past of the wrong length" % name
+            assert torch.allclose(expected, logits[0], atol=args.atol), "%s logits differ from the eager model" % name
+            max_diff[name] = max(max_diff[name], (expected - logits[0]).abs().max().item())
+    return max_diff
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--num_examples", type=int, default=50)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+    # greedy, so every step implementation has to pick the same tokens
+    args.no_sample, args.trie_drafts = True, False
+
+    output_dir = tempfile.mkdtemp()
+    step = DecoderStep(model).eval()
+    steps = {"eager step": step,
+             "torchscript": export_torchscript(step, os.path.join(output_dir, TORCHSCRIPT_NAME))}
+    try:
+        export_onnx(step, os.path.join(output_dir, ONNX_NAME))
+        steps["onnx"] = OnnxDecoderStep(os.path.join(output_dir, ONNX_NAME))
+    except ImportError as e:
+        print("skipping ONNX: %s" % e)
+
+    with torch.no_grad():
+        for name, diff in check_logits(args, model, steps, examples, dataset).items():
+            print("%-12s logits within %.2e of the eager model" % (name, diff))
+
+        def generate_all(generate, *step_args):
+            return [generate(args, model, *step_args, [example], dataset)[0] for example in examples]
+
+        expected, base_time = timed(generate_all, run_batch_generation_incremental)
+        print("%-12s %7.2fs" % ("eager", base_time))
+        for name, step in steps.items():
+            outputs, elapsed = timed(generate_all, run_batch_generation_step, step)
+            assert outputs == expected, "greedy responses through %s differ" % name
+            print("%-12s %7.2fs  speedup x%.2f" % (name, elapsed, base_time / elapsed))
+
+
+if __name__ == "__main__":
+    main()
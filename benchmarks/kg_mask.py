@@ -0,0 +1,130 @@
+""" Compare the per-position trie masking loop with kg_mask_indices/apply_kg_mask on a dev set, and the
+    per-step next_ones walk from the root with a KGMaskState cursor.
+
+    python -m benchmarks.kg_mask --dataset incar
+    python -m benchmarks.kg_mask --dataset camrest
+"""
+import argparse
+
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.common import add_dataset_args, get_tokenizer, load_dataset, timed, report
+from scripts.model import kg_mask_indices, apply_kg_mask, KGMaskState
+
+
+def legacy_kg_mask(lm_logits, input_ids, trie):
+    # the loop DistilGPT2LMHeadModel.forward used before kg_mask_indices
+    end_ids = 50258
+    new_probas = torch.zeros_like(lm_logits)
+    for idx, toks in enumerate(input_ids):
+        kgtrie = trie[idx]
+
+        out_ids = []
+        st_idx = (toks == torch.tensor(50268)).nonzero().item()
+        if kgtrie != []:
+            for idxx, tok in enumerate(toks):
+                if idxx > st_idx:
+                    out_ids.append(int(tok))
+                    try:
+                        next_ids = [int(j) for j in kgtrie.next_ones(out_ids)]
+                    except:
+                        next_ids = [50262]
+                    if not next_ids:
+                        next_ids.append(end_ids)
+                        break
+                    new_probas[idx][idxx][next_ids] += lm_logits[idx][idxx][next_ids]
+
+            ed_idx = 999
+            for idxxx, tokk in enumerate(toks):
+                if idxxx <= st_idx:
+                    new_probas[idx][idxxx][:] += lm_logits[idx][idxxx][:]
+                if tokk == 50262:
+                    ed_idx = idxxx
+                if idxxx >= ed_idx:
+                    new_probas[idx][idxxx][:] += lm_logits[idx][idxxx][:]
+        else:
+            new_probas[idx][:][:] += lm_logits[idx][:][:]
+    return new_probas
+
+
+def vectorized_kg_mask(lm_logits, input_ids, trie):
+    return apply_kg_mask(lm_logits, *kg_mask_indices(input_ids, trie))
+
+
+def legacy_step_masks(toks, kgtrie):
+    # the allowed ids of every step after [SKG], each one re-walking the trie from the root
+    st_idx = toks.index(50268)
+    masks, out_ids = [], []
+    for tok in toks[st_idx + 1:]:
+        out_ids.append(tok)
+        try:
+            next_ids = sorted(int(j) for j in kgtrie.next_ones(out_ids))
+        except KeyError:
+            next_ids = [50262]
+        masks.append(next_ids)
+        if not next_ids or next_ids == [50262]:
+            break
+    return masks
+
+
+def cursor_step_masks(toks, kgtrie):
+    st_idx = toks.index(50268)
+    state = KGMaskState(kgtrie, toks[:st_idx + 1])
+    masks = []
+    for tok in toks[st_idx + 1:]:
+        state.update(tok)
+        next_ids = sorted(state.kg_mask()[1][2].tolist())
+        masks.append(next_ids)
+        if not next_ids or next_ids == [50262]:
+            break
+    return masks
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_batches", type=int, default=-1)
+    args = parser.parse_args()
+
+    tokenizer = get_tokenizer(args)
+    dataset = load_dataset(args, tokenizer)
+    loader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=dataset.collate_fn)
+
+    legacy_time, vectorized_time, n_batches = 0.0, 0.0, 0
+    with torch.no_grad():
+        for batch in loader:
+            input_ids, trie = batch[0], batch[-1]
+            lm_logits = torch.randn(input_ids.size(0), input_ids.size(1), len(tokenizer))
+            expected, seconds = timed(legacy_kg_mask, lm_logits, input_ids, trie)
+            legacy_time += seconds
+            result, seconds = timed(vectorized_kg_mask, lm_logits, input_ids, trie)
+            vectorized_time += seconds
+            assert torch.equal(expected, result), "masked logits differ"
+            n_batches += 1
+            if n_batches == args.max_batches:
+                break
+
+    print("%s/%s: %d batches of %d, identical logits" % (args.dataset, args.split, n_batches, args.batch_size))
+    report("legacy loop", legacy_time, n_batches)
+    report("kg_mask_indices + apply", vectorized_time, n_batches)
+
+    walk_time, cursor_time, n_sequences = 0.0, 0.0, 0
+    for i in range(min(len(dataset), n_batches * args.batch_size)):
+        instance = dataset[i]
+        toks, kgtrie = instance["input_ids"], instance["trie"]
+        if kgtrie == [] or 50268 not in toks:
+            continue
+        expected, seconds = timed(legacy_step_masks, toks, kgtrie)
+        walk_time += seconds
+        result, seconds = timed(cursor_step_masks, toks, kgtrie)
+        cursor_time += seconds
+        assert expected == result, "step masks differ"
+        n_sequences += 1
+    print("%d sequences, identical step masks" % n_sequences)
+    report("next_ones from the root", walk_time, n_sequences, unit="sequence")
+    report("KGMaskState cursor", cursor_time, n_sequences, unit="sequence")
+
+
+if __name__ == "__main__":
+    main()
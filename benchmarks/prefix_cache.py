@@ -0,0 +1,45 @@
+""" Prompt reuse of SessionPrefixCache over consecutive turns of a split: time to generate with and without
+    the cache, and the share of prompt positions that did not have to run.
+
+    python -m benchmarks.prefix_cache --dataset incar --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed, set_seed
+from scripts.model import SessionPrefixCache, run_batch_generation_incremental
+
+
+def generate_all(args, model, examples, dataset):
+    outputs = []
+    for i, example in enumerate(examples):
+        # the min_length resampling draws from the RNG, keep it aligned between runs
+        set_seed(args.seed + i)
+        outputs.append(run_batch_generation_incremental(args, model, [example], dataset)[0])
+    return outputs
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--prefix_cache_mb", type=float, default=256)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+
+    with torch.no_grad():
+        model.transformer.prefix_cache = None
+        plain, plain_time = timed(generate_all, args, model, examples, dataset)
+        model.transformer.prefix_cache = SessionPrefixCache(int(args.prefix_cache_mb * 2 ** 20))
+        cached, cached_time = timed(generate_all, args, model, examples, dataset)
+    assert plain == cached, "generation with the prefix cache differs"
+    print("%s/%s: %d turns" % (args.dataset, args.split, len(examples)))
+    print("no prefix cache  %7.2fs" % plain_time)
+    print("prefix cache     %7.2fs  speedup x%.2f" % (cached_time, plain_time / cached_time))
+    print(model.transformer.prefix_cache.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+""" Entity-F1, BLEU and tokens per second of CPU generation with the fp32 model and its dynamic int8 version.
+
+    python -m benchmarks.quantization --dataset incar --model_name_or_path runs/uni-tod/incar
+    python -m benchmarks.quantization --dataset incar --model_name_or_path runs/uni-tod/incar \\
+        --quantized_path runs/uni-tod/incar-int8
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed, set_seed, score_responses
+from scripts.model import DistilGPT2LMHeadModel, run_batch_generation_sample
+from scripts.quantization import load_model, quantize_int8
+
+
+def generate_all(args, model, examples, dataset):
+    outputs = []
+    for i, example in enumerate(examples):
+        set_seed(args.seed + i)
+        outputs.append(run_batch_generation_sample(args, model, [example], dataset))
+    return outputs
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--quantized_path", type=str, default="",
+                        help="Output of scripts.quantization, by default the model is quantized here")
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+    models = [("fp32", model)]
+    if args.quantized_path:
+        models.append(("int8", load_model(args.quantized_path).eval()))
+    else:
+        models.append(("int8", quantize_int8(DistilGPT2LMHeadModel.from_pretrained(args.model_name_or_path))))
+
+    print("%s/%s: %d turns" % (args.dataset, args.split, len(examples)))
+    for name, model in models:
+        with torch.no_grad():
+            outputs, seconds = timed(generate_all, args, model, examples, dataset)
+        bleu, entity_f1 = score_responses(args, outputs)
+        n_tokens = sum(len(output[0]) for output in outputs)
+        print("%-5s BLEU %.4f  Entity-F1 %.4f  %7.1f tokens/s" % (name, bleu, entity_f1, n_tokens / seconds))
+
+
+if __name__ == "__main__":
+    main()
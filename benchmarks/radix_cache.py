@@ -0,0 +1,63 @@
+""" RadixKVCache over the prompts of a split: the logits of the positions that run after a cached prefix
+    against a run without the cache, then the time to generate with and without it.
+
+    python -m benchmarks.radix_cache --dataset incar --model_name_or_path runs/uni-tod/incar
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed
+from benchmarks.prefix_cache import generate_all
+from scripts.model import RadixKVCache
+
+
+def check_logits(args, model, examples, dataset):
+    """ Largest difference between the logits with and without the cache, over the positions that ran """
+    max_diff = 0.0
+    for example in examples:
+        instance, _ = dataset.build_input_from_segments(example["knowledge"], example["history"], [], example["trie"],
+                                                        example, with_eos=False)
+        input_ids = torch.tensor(instance["input_ids"], device=args.device).unsqueeze(0)
+        token_type_ids = torch.tensor(instance["token_type_ids"], device=args.device).unsqueeze(0)
+        model.transformer.prefix_cache = None
+        expected = model(input_ids=input_ids, token_type_ids=token_type_ids, trie=[example["trie"]])[0]
+        model.transformer.prefix_cache = args.cache
+        logits = model(input_ids=input_ids, token_type_ids=token_type_ids, trie=[example["trie"]],
+                       session_id=example["dialog_id"])[0]
+        expected = expected[:, -logits.size(1):]
+        assert torch.allclose(expected, logits, atol=args.atol), "logits with the radix cache differ"
+        max_diff = max(max_diff, (expected - logits).abs().max().item())
+    return max_diff
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--radix_cache_mb", type=float, default=256)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+    max_bytes = int(args.radix_cache_mb * 2 ** 20)
+
+    with torch.no_grad():
+        args.cache = RadixKVCache(max_bytes)
+        max_diff = check_logits(args, model, examples, dataset)
+        print("%s/%s: %d prompts, logits within %.2e of the uncached run" % (
+            args.dataset, args.split, len(examples), max_diff))
+        print(args.cache.report())
+
+        model.transformer.prefix_cache = None
+        plain, plain_time = timed(generate_all, args, model, examples, dataset)
+        model.transformer.prefix_cache = RadixKVCache(max_bytes)
+        cached, cached_time = timed(generate_all, args, model, examples, dataset)
+    assert plain == cached, "generation with the radix cache differs"
+    print("no radix cache  %7.2fs" % plain_time)
+    print("radix cache     %7.2fs  speedup x%.2f" % (cached_time, plain_time / cached_time))
+    print(model.transformer.prefix_cache.report())
+
+
+if __name__ == "__main__":
+    main()
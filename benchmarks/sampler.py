@@ -0,0 +1,44 @@
+""" Padding efficiency of random batches against BucketBatchSampler, by batch size and by token budget.
+
+    python -m benchmarks.sampler --dataset camrest --split train --batch_size 4 --max_tokens 2048
+"""
+import argparse
+
+from torch.utils.data import BatchSampler, RandomSampler
+
+from benchmarks.common import add_dataset_args, get_tokenizer, load_dataset, set_seed
+from utils.sampler import BucketBatchSampler
+
+
+def describe(name, batches, lengths):
+    real = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    print("%-24s %6d batches  %6.1f examples/batch  %9d padded tokens  efficiency %5.1f%%" % (
+        name, len(batches), sum(map(len, batches)) / len(batches), padded, 100.0 * real / padded))
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_tokens", type=int, default=2048)
+    parser.add_argument("--epochs", type=int, default=2)
+    args = parser.parse_args()
+    set_seed(42)
+
+    dataset = load_dataset(args, get_tokenizer(args))
+    lengths = dataset.lengths()
+    print("%s/%s: %d examples, length %d..%d, mean %.1f" % (
+        args.dataset, args.split, len(lengths), min(lengths), max(lengths), sum(lengths) / len(lengths)))
+
+    describe("random", list(BatchSampler(RandomSampler(range(len(lengths))), args.batch_size, False)), lengths)
+    for name, sampler in [("bucket batch_size", BucketBatchSampler(lengths, batch_size=args.batch_size)),
+                          ("bucket max_tokens", BucketBatchSampler(lengths, max_tokens=args.max_tokens))]:
+        for epoch in range(args.epochs):
+            sampler.set_epoch(epoch)
+            batches = list(sampler)
+            assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+            describe("%s epoch %d" % (name, epoch), batches, lengths)
+
+
+if __name__ == "__main__":
+    main()
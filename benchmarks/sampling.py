@@ -0,0 +1,77 @@
+""" Per-row top_filtering + sampling (the min_length resample loop included) against the batched
+    sample_tokens, for batches of random logits the size of the vocabulary.
+
+    python -m benchmarks.sampling
+    python -m benchmarks.sampling --batch_sizes 1 8 32 --top_k 0
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import timed, report, set_seed
+from scripts.model import top_filtering
+from scripts.sampling import filter_logits, sample_tokens
+
+SPECIAL_TOKENS_IDS = list(range(50257, 50270))
+
+
+def legacy_sample(logits, args, i):
+    # sample_next_token with top_filtering, one row at a time
+    tokens = []
+    for row in logits:
+        row = top_filtering(row / args.temperature, top_k=args.top_k, top_p=args.top_p, threshold=args.threshold)
+        probs = F.softmax(row, dim=-1)
+        prev = torch.multinomial(probs, 1)
+        if i < args.min_length:
+            while prev.item() in SPECIAL_TOKENS_IDS and probs[SPECIAL_TOKENS_IDS].sum().item() < 1:
+                prev = torch.multinomial(probs, 1)
+        tokens.append(prev.item())
+    return tokens
+
+
+def batched_sample(logits, args, i):
+    return sample_tokens(logits, args.temperature, top_k=args.top_k, top_p=args.top_p, threshold=args.threshold,
+                         banned_ids=SPECIAL_TOKENS_IDS if i < args.min_length else None).tolist()
+
+
+def kept(logits, args):
+    # the (row, token) pairs both filters keep
+    legacy = torch.stack([top_filtering(row.clone(), top_k=args.top_k, top_p=args.top_p, threshold=args.threshold)
+                          for row in logits])
+    values, indices = filter_logits(logits, top_k=args.top_k, top_p=args.top_p, threshold=args.threshold)
+    batched = torch.zeros_like(logits, dtype=torch.bool).scatter_(-1, indices, torch.isfinite(values))
+    return torch.isfinite(legacy), batched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--vocab_size", type=int, default=50270)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.18)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--threshold", type=float, default=-float("inf"))
+    parser.add_argument("--min_length", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    set_seed(args.seed)
+
+    for batch_size in args.batch_sizes:
+        legacy_time, batched_time = 0.0, 0.0
+        for i in range(args.steps):
+            logits = torch.randn(batch_size, args.vocab_size) * 4
+            expected, result = kept(logits, args)
+            assert torch.equal(expected, result), "filtered candidates differ"
+            _, seconds = timed(legacy_sample, logits, args, i)
+            legacy_time += seconds
+            _, seconds = timed(batched_sample, logits, args, i)
+            batched_time += seconds
+        print("batch %d, top_k %d, top_p %.2f: identical candidates" % (batch_size, args.top_k, args.top_p))
+        report("top_filtering per row", legacy_time, args.steps, unit="step")
+        report("sample_tokens", batched_time, args.steps, unit="step")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+""" Training step (forward + backward) of DistilGPT2LMHeadModel with the dense kg-masked logits against
+    sparse_logits: step time, peak memory and the loss of both, on training batches padded to seq_len.
+
+    python -m benchmarks.sparse_logits --dataset incar --split train --batch_size 4 --seq_len 1024
+"""
+import argparse
+import multiprocessing
+import resource
+
+import torch
+
+from benchmarks.common import add_dataset_args, get_tokenizer, load_dataset, timed, report, set_seed
+from scripts.model import DistilGPT2LMHeadModel
+
+
+def pad_batch(batch, pad, seq_len):
+    """ Pad (or cut) a collated training batch to seq_len, the labels of the padding are -100 """
+    input_ids, token_type_ids, pos_ids, lm_labels, trie = batch
+    length = min(seq_len, input_ids.size(1))
+    padded = []
+    for tensor, value in ((input_ids, pad), (token_type_ids, pad), (lm_labels, -100)):
+        out = tensor.new_full((tensor.size(0), seq_len), value)
+        out[:, :length] = tensor[:, :length]
+        padded.append(out)
+    return padded[0], padded[1], padded[2], trie
+
+
+def train_steps(args, sparse_logits):
+    """ Run in a fresh process: (losses, seconds, peak memory in MB) of args.steps training steps """
+    set_seed(args.seed)
+    tokenizer = get_tokenizer(args)
+    dataset = load_dataset(args, tokenizer)
+    model = DistilGPT2LMHeadModel.from_pretrained(args.model_name_or_path).to(args.device).train()
+    model.resize_token_embeddings(len(tokenizer))
+    batches = [
+        pad_batch(dataset.collate_fn([dataset[j] for j in range(i * args.batch_size, (i + 1) * args.batch_size)]),
+                  dataset.pad, args.seq_len)
+        for i in range(args.steps)
+    ]
+
+    def step(input_ids, token_type_ids, lm_labels, trie):
+        loss = model(input_ids=input_ids.to(args.device), token_type_ids=token_type_ids.to(args.device),
+                     labels=lm_labels.to(args.device), trie=trie, sparse_logits=sparse_logits)[0]
+        loss.backward()
+        model.zero_grad()
+        return loss.item()
+
+    if args.device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    losses, seconds = [], 0.0
+    for batch in batches:
+        loss, elapsed = timed(step, *batch)
+        losses.append(loss)
+        seconds += elapsed
+    if args.device == "cuda":
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return losses, seconds, peak
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # one process per mode, so that the peak (resident) memory of one does not hide the other
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        dense = pool.apply(train_steps, (args, False))
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        sparse = pool.apply(train_steps, (args, True))
+    for expected, result in zip(dense[0], sparse[0]):
+        assert abs(expected - result) <= 1e-4 * max(1.0, abs(expected)), "losses differ: %f %f" % (expected, result)
+
+    memory = "GPU allocated" if args.device == "cuda" else "process RSS"
+    print("%s/%s: %d steps of %d x %d, same losses (last %.4f)" % (
+        args.dataset, args.split, args.steps, args.batch_size, args.seq_len, sparse[0][-1]))
+    for name, (_, seconds, peak) in (("dense logits", dense), ("sparse_logits", sparse)):
+        report(name, seconds, args.steps, unit="step")
+        print("%-28s peak %s %8.1f MB" % ("", memory, peak))
+
+
+if __name__ == "__main__":
+    main()
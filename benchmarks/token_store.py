@@ -0,0 +1,60 @@
+""" Resident memory of DataLoader workers with the examples held as Python lists ("memory") or
+    read from the memory-mapped token store ("mmap").
+
+    python -m benchmarks.token_store --dataset camrest --split train --num_workers 4
+"""
+import argparse
+
+from torch.utils.data import DataLoader, get_worker_info
+
+from benchmarks.common import add_dataset_args, get_tokenizer, get_dataset_args, dataset_module
+
+
+def memory_usage():
+    """ (rss, pss, private) of the current process in KB """
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                fields[parts[0][:-1]] = int(parts[1])
+    return fields["Rss"], fields["Pss"], fields["Private_Clean"] + fields["Private_Dirty"]
+
+
+class MemoryCollate(object):
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        info = get_worker_info()
+        return self.collate_fn(batch), (info.id if info is not None else -1, memory_usage())
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--multiprocessing_context", type=str, default="fork", choices=["fork", "spawn"])
+    args = parser.parse_args()
+    tokenizer = get_tokenizer(args)
+    module = dataset_module(args.dataset)
+
+    for storage in ["memory", "mmap"]:
+        dataset_args = get_dataset_args(args)
+        dataset_args.example_storage = storage
+        dataset = module.Dataset(dataset_args, tokenizer, args.dataset, args.split)
+        loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                            collate_fn=MemoryCollate(dataset.collate_fn),
+                            multiprocessing_context=args.multiprocessing_context)
+        workers = {}
+        for _, (worker_id, usage) in loader:
+            workers[worker_id] = usage
+        n = max(len(workers), 1)
+        rss, pss, private = [sum(usage[i] for usage in workers.values()) / n / 1024 for i in range(3)]
+        print("%-6s main rss %7.1f MB | per worker: rss %7.1f MB  pss %7.1f MB  private %7.1f MB" % (
+            storage, memory_usage()[0] / 1024, rss, pss, private))
+        del loader, dataset
+
+
+if __name__ == "__main__":
+    main()
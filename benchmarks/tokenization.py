@@ -0,0 +1,47 @@
+""" Tokenization time of example creation: one tokenize call per string against TokenizerMemo.
+
+    python -m benchmarks.tokenization --dataset camrest --split train
+"""
+import argparse
+
+from transformers import GPT2TokenizerFast
+
+from benchmarks.common import add_dataset_args, dataset_module, get_tokenizer, load_dataset, timed, report
+from scripts.tokenizer_memo import TokenizerMemo
+
+
+def tokenize_each(tokenizer, texts):
+    return [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)) for text in texts]
+
+
+def tokenize_memo(tokenizer, texts):
+    memo = TokenizerMemo(tokenizer)
+    memo.prime(texts)
+    return [memo.encode(text) for text in texts]
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--fast_tokenizer", action="store_true", help="Start from GPT2TokenizerFast")
+    args = parser.parse_args()
+    if args.fast_tokenizer:
+        tokenizer = GPT2TokenizerFast.from_pretrained(args.model_name_or_path)
+        tokenizer.add_special_tokens(dataset_module(args.dataset).SPECIAL_TOKENS)
+    else:
+        tokenizer = get_tokenizer(args)
+
+    dataset = load_dataset(args, tokenizer)
+    texts = dataset._example_texts()
+    print("%s/%s: %d strings, %d unique" % (args.dataset, args.split, len(texts), len(set(texts))))
+
+    each, each_time = timed(tokenize_each, tokenizer, texts)
+    memo, memo_time = timed(tokenize_memo, tokenizer, texts)
+    assert each == memo, "TokenizerMemo ids differ from tokenizer.tokenize"
+    report("tokenize per string", each_time, len(texts), unit="string")
+    report("TokenizerMemo", memo_time, len(texts), unit="string")
+    _, build_time = timed(dataset._create_examples)
+    report("_create_examples", build_time, len(dataset.examples), unit="example")
+
+
+if __name__ == "__main__":
+    main()
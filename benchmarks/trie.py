@@ -0,0 +1,86 @@
+""" Memory use and lookup time of Trie against ArrayTrie over all KG tries of a split.
+
+    python -m benchmarks.trie --dataset camrest --split train
+"""
+import argparse
+import gc
+import pickle
+import time
+import tracemalloc
+from os.path import join
+
+from benchmarks.common import add_dataset_args, get_tokenizer, dataset_module, report
+from scripts.trie import Trie, ArrayTrie, get_trie, kgsort, incarkgsort
+
+
+def build_tries(args, tokenizer):
+    module = dataset_module(args.dataset)
+    order = incarkgsort if args.dataset == "incar" else kgsort
+    with open(join(args.dataroot, args.dataset, args.split + ".pkl"), "rb") as f:
+        dialogs = pickle.load(f)
+    tries = []
+    for dialog in dialogs:
+        kgdict_m = module.BaseDataset._knowledge_to_sequence(None, dialog["kg"])
+        kgdict_r = module.BaseDataset._knowledge_to_sequence(None, dialog["kg_tripe"])
+        if kgdict_m != {} and kgdict_r != {}:
+            tries.append(get_trie(kgdict_m, order, Trie(), tokenizer))
+    return tries
+
+
+def traced(fn, *inputs):
+    """ Run fn(*inputs) and return (result, bytes it still holds) """
+    gc.collect()
+    tracemalloc.start()
+    result = fn(*inputs)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def lookup_next_ones(tries, all_keys):
+    # the access pattern of the old forward: walk from the root for every prefix, str keys back to int
+    for trie, keys in zip(tries, all_keys):
+        for key in keys:
+            for i in range(len(key) + 1):
+                if isinstance(trie, ArrayTrie):
+                    trie.next_ones(key[:i])
+                else:
+                    [int(j) for j in trie.next_ones(key[:i])]
+
+
+def lookup_cursor(tries, all_keys):
+    # the access pattern of kg_mask_indices / KGMaskState: one child step per token
+    for trie, keys in zip(tries, all_keys):
+        for key in keys:
+            node = trie.root
+            trie.next_ids(node)
+            for tok in key:
+                node = trie.child(node, tok)
+                trie.next_ids(node)
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    args = parser.parse_args()
+    tokenizer = get_tokenizer(args)
+
+    tries, trie_bytes = traced(build_tries, args, tokenizer)
+    array_tries, array_bytes = traced(lambda: [ArrayTrie.from_trie(trie) for trie in tries])
+    all_keys = [[[int(k) for k in key] for key in trie.keys()] for trie in tries]
+    n_keys = sum(len(keys) for keys in all_keys)
+    n_lookups = sum(len(key) + 1 for keys in all_keys for key in keys)
+
+    print("%s/%s: %d tries, %d keys, %d prefixes" % (args.dataset, args.split, len(tries), n_keys, n_lookups))
+    print("Trie      %10.1f KB  (%.0f B/key)" % (trie_bytes / 1024, trie_bytes / max(n_keys, 1)))
+    print("ArrayTrie %10.1f KB  (%.0f B/key, arrays only %.1f KB)" % (
+        array_bytes / 1024, array_bytes / max(n_keys, 1), sum(t.nbytes for t in array_tries) / 1024))
+    for name, fn in [("next_ones", lookup_next_ones), ("child/next_ids", lookup_cursor)]:
+        for cls_name, objs in [("Trie", tries), ("ArrayTrie", array_tries)]:
+            start = time.perf_counter()
+            fn(objs, all_keys)
+            report("%s %s" % (cls_name, name), time.perf_counter() - start, n_lookups, unit="prefix")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+""" Forward passes per response of run_batch_generation_incremental with and without trie drafts, and a
+    check that the responses are the same.
+
+    python -m benchmarks.trie_drafts --dataset incar --model_name_or_path runs/uni-tod/incar
+    python -m benchmarks.trie_drafts --dataset camrest --model_name_or_path runs/uni-tod/camrest
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import add_dataset_args, load_eval_setup, timed
+from benchmarks.prefix_cache import generate_all
+
+
+def main():
+    parser = add_dataset_args(argparse.ArgumentParser())
+    parser.add_argument("--generation_params_file", type=str, default="config/gpt2/generation_params.json")
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    model, dataset, examples = load_eval_setup(args)
+
+    n_forward = [0]
+    model.register_forward_hook(lambda module, inputs, outputs: n_forward.__setitem__(0, n_forward[0] + 1))
+
+    results = {}
+    with torch.no_grad():
+        for trie_drafts in (False, True):
+            args.trie_drafts = trie_drafts
+            n_forward[0] = 0
+            outputs, seconds = timed(generate_all, args, model, examples, dataset)
+            results[trie_drafts] = outputs, seconds, n_forward[0]
+    assert results[False][0] == results[True][0], "generation with trie drafts differs"
+
+    n_tokens = sum(len(output) for output in results[False][0])
+    print("%s/%s: %d responses, %d tokens, identical outputs" % (args.dataset, args.split, len(examples), n_tokens))
+    for trie_drafts, name in ((False, "step by step"), (True, "trie drafts")):
+        _, seconds, passes = results[trie_drafts]
+        print("%-13s %7.2fs  %6.2f forward passes/response" % (name, seconds, passes / len(examples)))
+    print("forward passes x%.2f fewer" % (results[False][2] / results[True][2]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,13 @@
-import torch
-from torch.utils.data import DataLoader, Dataset
-from utils.dataset_utils import pad_ids, truncate_sequences
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+from utils.dataset_utils import TensorCollator, truncate_sequences
+from utils.dialog_io import dialog_source, iter_dialogs
 from itertools import chain
 from tqdm import tqdm
 import numpy as np
-from os.path import join
 import pickle
-from .trie import Trie, get_trie, incarkgsort, get_kg_res
+from .example_cache import load_or_create_examples
+from .tokenizer_memo import TokenizerMemo
+from .trie import TrieCache, get_trie_texts, incarkgsort, get_kg_res
 
 SPECIAL_TOKENS = {
     "bos_token": "[BOS]",
@@ -30,9 +31,12 @@ class BaseDataset(Dataset):
         self.eos = self.tokenizer.convert_tokens_to_ids(self.SPECIAL_TOKENS["eos_token"])
         self.pad = self.tokenizer.convert_tokens_to_ids(self.SPECIAL_TOKENS["pad_token"])
         self.sys_token, self.usr_token, self.kg, self.sub_token, self.pred_token, self.obj_token, self.triple_token, self.sep,self.skg = self.tokenizer.convert_tokens_to_ids(self.SPECIAL_TOKENS["additional_special_tokens"])
+        self._load_examples(name, split_type)
+
+    def _load_examples(self, name, split_type):
         self.dialogs = self._prepare_conversations(dataset=name, split_type=split_type)
 
-        self._create_examples()
+        load_or_create_examples(self, name)
 
     def build_input_from_segments(self, knowledge, history, response, trie, example, with_eos=True):
         """ Build a sequence of input from 3 segments: knowledge, history and last reply """
@@ -56,7 +60,10 @@ class BaseDataset(Dataset):
 
     def _prepare_conversations(self, dataset="incar", split_type="train"):
         print("Loading dialogue data...")
-        formatted_dialogs = pickle.load(open(join("data",dataset,split_type+".pkl"),"rb"))
+        path = dialog_source("data", dataset, split_type)
+        if path.endswith(".jsonl"):
+            return list(iter_dialogs(path))
+        formatted_dialogs = pickle.load(open(path,"rb"))
         return formatted_dialogs
 
     def _knowledge_to_sequence(self, kg):
@@ -70,54 +77,80 @@ class BaseDataset(Dataset):
         return kg_dict.copy()
 
 
+    def _dialog_texts(self, dialog):
+        """ Every string _create_example tokenizes: turns, KG entities and the response """
+        texts = list(dialog["history"])
+        kgdict_m = self._knowledge_to_sequence(dialog["kg"])
+        kgdict_r = self._knowledge_to_sequence(dialog["kg_tripe"])
+        if kgdict_m !={} and kgdict_r !={}:
+            texts += get_trie_texts(kgdict_m, incarkgsort)
+            texts.append(' '+' '.join(get_kg_res(kgdict_r, incarkgsort))+' '+dialog["response"])
+        else:
+            texts.append(' '+"[EKG]"+' '+ dialog["response"])
+        return texts
+
+    def _example_texts(self):
+        return [text for dialog in self.dialogs for text in self._dialog_texts(dialog)]
+
     def _create_examples(self):
         print("Creating examples")
         self.examples = []
-        for dialog in tqdm(self.dialogs):
-            dialog_id = dialog["id"]
-            ref_ents = dialog["ref_ents"]
-
-            kgdict_m = self._knowledge_to_sequence(dialog["kg"])
-            kgdict_r = self._knowledge_to_sequence(dialog["kg_tripe"])
-
-            if kgdict_m !={} and kgdict_r !={}:
-                all_kg = Trie()
-                kgtrie = get_trie(kgdict_m, incarkgsort, all_kg, self.tokenizer)
-                kgres = get_kg_res(kgdict_r, incarkgsort)
-            else:
-                kgtrie=[]
-                kgres = []
-
-
-            used_knowledge = self.tokenizer.convert_tokens_to_ids([])
-            used_knowledge = used_knowledge[:self.args.knowledge_max_tokens]
-
-            history = [self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(turn)) for turn in dialog["history"]]
-            if kgtrie !=[]:
-                gt_resp = ' '+' '.join(kgres)+' '+dialog["response"]
-            else:
-                gt_resp =' '+"[EKG]"+' '+ dialog["response"]
-
-            tokenized_gt_resp = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(gt_resp))
-
-            # apply history threshold at an utterance-level (a large value can be used to nullify its effect)
-            truncated_history = history[-self.args.history_max_utterances:]
+        self.trie_cache = TrieCache()
+        tokenizer_memo = TokenizerMemo(self.tokenizer)
 
-            # perform token-level truncation of history from the left
-            truncated_history = truncate_sequences(truncated_history, self.args.history_max_tokens)
-            truncated_history[-1] = truncated_history[-1] + [self.tokenizer.convert_tokens_to_ids("[SKG]")]
+        # tokenize the strings of all dialogs up front, in a few large batches
+        texts = self._example_texts()
+        tokenizer_memo.prime(texts)
+        print("Tokenized %d unique strings out of %d" % (len(tokenizer_memo), len(texts)))
 
-            self.examples.append({
-                "history": truncated_history,
-                "task": dialog["task"],
-                "knowledge": used_knowledge,
-                "knowledge_text": dialog["kg"],
-                "response": tokenized_gt_resp,
-                "response_text": gt_resp,
-                "dialog_id": dialog_id,
-                "reference_entities": ref_ents,
-                'trie':kgtrie
-            })
+        for dialog in tqdm(self.dialogs):
+            self.examples.append(self._create_example(dialog, tokenizer_memo))
+        print(self.trie_cache.report())
+
+    def _create_example(self, dialog, tokenizer_memo):
+        dialog_id = dialog["id"]
+        ref_ents = dialog["ref_ents"]
+
+        kgdict_m = self._knowledge_to_sequence(dialog["kg"])
+        kgdict_r = self._knowledge_to_sequence(dialog["kg_tripe"])
+
+        if kgdict_m !={} and kgdict_r !={}:
+            kgtrie = self.trie_cache.get_trie(kgdict_m, incarkgsort, tokenizer_memo)
+            kgres = get_kg_res(kgdict_r, incarkgsort)
+        else:
+            kgtrie=[]
+            kgres = []
+
+
+        used_knowledge = self.tokenizer.convert_tokens_to_ids([])
+        used_knowledge = used_knowledge[:self.args.knowledge_max_tokens]
+
+        history = tokenizer_memo.encode_history(dialog["history"])
+        if kgtrie !=[]:
+            gt_resp = ' '+' '.join(kgres)+' '+dialog["response"]
+        else:
+            gt_resp =' '+"[EKG]"+' '+ dialog["response"]
+
+        tokenized_gt_resp = tokenizer_memo.encode(gt_resp)
+
+        # apply history threshold at an utterance-level (a large value can be used to nullify its effect)
+        truncated_history = history[-self.args.history_max_utterances:]
+
+        # perform token-level truncation of history from the left
+        truncated_history = truncate_sequences(truncated_history, self.args.history_max_tokens)
+        truncated_history[-1] = truncated_history[-1] + [self.tokenizer.convert_tokens_to_ids("[SKG]")]
+
+        return {
+            "history": truncated_history,
+            "task": dialog["task"],
+            "knowledge": used_knowledge,
+            "knowledge_text": dialog["kg"],
+            "response": tokenized_gt_resp,
+            "response_text": gt_resp,
+            "dialog_id": dialog_id,
+            "reference_entities": ref_ents,
+            'trie':kgtrie
+        }
 
     def __getitem__(self, index):
         raise NotImplementedError
@@ -129,27 +162,66 @@ class BaseDataset(Dataset):
 class Dataset(BaseDataset):
     def __init__(self, args, tokenizer, name, split_type, labels=True, labels_file=None):
         super(Dataset, self).__init__(args, tokenizer, name, split_type, labels, labels_file)
+        self.collator = TensorCollator(self.pad, pin_memory=getattr(args, "pin_memory", False))
 
     def __getitem__(self, index):
         example = self.examples[index]
         instance, _ = self.build_input_from_segments(example["knowledge"],example["history"],example["response"], example["trie"], example)
         return instance
 
+    def lengths(self):
+        """ len(input_ids) of every example, e.g. for utils.sampler.BucketBatchSampler """
+        return [len(self[i]["input_ids"]) for i in range(len(self))]
+
     def collate_fn(self, batch):
-        maxlen = 1024
-        input_ids = [ins["input_ids"] for ins in batch]
-        token_type_ids = [ins["token_type_ids"] for ins in batch]
-        lm_labels = [ins["lm_labels"] for ins in batch]
-        pos_ids = [ins["pos_ids"] for ins in batch]
+        input_ids, token_type_ids, pos_ids, lm_labels = self.collator(batch)
         trie = [ins["trie"] for ins in batch]
-
-        input_ids = torch.tensor(pad_ids(input_ids, self.pad))
-        token_type_ids = torch.tensor(pad_ids(token_type_ids, self.pad))
-        pos_ids = torch.tensor(pad_ids(pos_ids, self.pad))
-        lm_labels = torch.tensor(pad_ids(lm_labels, -100))
         return input_ids, token_type_ids, pos_ids, lm_labels, trie
 
 
+class StreamingDataset(IterableDataset, Dataset):
+    """ Dataset that streams instances from the .jsonl split instead of holding all examples. Dialogs
+        are read chunk_size at a time, tokenized together and turned into instances; the tokenizer memo
+        and the trie cache only live for one chunk. DataLoader workers take every num_workers-th dialog.
+    """
+
+    def __init__(self, args, tokenizer, name, split_type, labels=True, labels_file=None, chunk_size=256):
+        self.chunk_size = chunk_size
+        super(StreamingDataset, self).__init__(args, tokenizer, name, split_type, labels, labels_file)
+
+    def _load_examples(self, name, split_type):
+        self.source = dialog_source("data", name, split_type)
+        if not self.source.endswith(".jsonl"):
+            raise ValueError("%s: streaming needs the .jsonl split (python -m utils.dialog_io %s)" % (
+                self.source, self.source))
+
+    def _stream_chunk(self, dialogs, tokenizer_memo):
+        self.trie_cache = TrieCache()
+        tokenizer_memo.clear()
+        tokenizer_memo.prime([text for dialog in dialogs for text in self._dialog_texts(dialog)])
+        for dialog in dialogs:
+            example = self._create_example(dialog, tokenizer_memo)
+            instance, _ = self.build_input_from_segments(example["knowledge"],example["history"],example["response"], example["trie"], example)
+            yield instance
+
+    def __iter__(self):
+        worker = get_worker_info()
+        tokenizer_memo = TokenizerMemo(self.tokenizer)
+        chunk = []
+        for i, dialog in enumerate(iter_dialogs(self.source)):
+            if worker is not None and i % worker.num_workers != worker.id:
+                continue
+            chunk.append(dialog)
+            if len(chunk) == self.chunk_size:
+                yield from self._stream_chunk(chunk, tokenizer_memo)
+                chunk = []
+        if chunk:
+            yield from self._stream_chunk(chunk, tokenizer_memo)
+
+    def __len__(self):
+        raise TypeError("StreamingDataset has no length")
+
+
 class EvalDataset(BaseDataset):
     def __init__(self, args, tokenizer, name, split_type, labels=True, labels_file=None):
         super(EvalDataset, self).__init__(args, tokenizer, name, split_type, labels, labels_file)
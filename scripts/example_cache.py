@@ -0,0 +1,192 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from os.path import join, exists
+
+import numpy as np
+
+from utils.dialog_io import dialog_source
+
+from .parallel_build import create_examples
+from .trie import ArrayTrie
+from .token_store import TokenStore, StoredExamples
+
+# bump whenever the example format or the way _create_examples builds examples changes
+EXAMPLE_CACHE_VERSION = 2
+
+
+def tokenizer_fingerprint(tokenizer):
+    """ Hash of everything that decides the token ids: vocab, added tokens and merges """
+    if hasattr(tokenizer, "backend_tokenizer"):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = json.dumps([sorted(tokenizer.get_vocab().items()),
+                            sorted(" ".join(pair) for pair in getattr(tokenizer, "bpe_ranks", {}))])
+    return hashlib.sha1(state.encode("utf-8")).hexdigest()
+
+
+def example_cache_key(dataset, split_type, tokenizer, args, source=None):
+    key = {
+        "version": EXAMPLE_CACHE_VERSION,
+        "dataset": dataset,
+        "split": split_type,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "history_max_tokens": args.history_max_tokens,
+        "history_max_utterances": args.history_max_utterances,
+        "knowledge_max_tokens": args.knowledge_max_tokens,
+    }
+    if source is not None and exists(source):
+        stat = os.stat(source)
+        key["source"] = [stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def example_cache_path(cache_dir, dataset, split_type, key):
+    return join(cache_dir, "%s_%s_%s" % (dataset, split_type, key[:16]))
+
+
+def load_or_create_examples(dataset, name):
+    """ Set dataset.examples from the cache when its key inputs are unchanged, else run
+        dataset._create_examples() and store the result. args.example_cache_dir (default
+        data/<name>/cache) picks the directory, an empty value disables the cache.
+        With args.example_storage == "mmap" the token ids stay in the memory-mapped cache files
+        (see StoredExamples) instead of Python lists. args.dataset_workers > 1 builds the examples
+        on that many processes (see parallel_build.create_examples).
+    """
+    num_workers = getattr(dataset.args, "dataset_workers", 1)
+    cache_dir = getattr(dataset.args, "example_cache_dir", join("data", name, "cache"))
+    if not cache_dir:
+        create_examples(dataset, num_workers)
+        return
+
+    source = dialog_source("data", name, dataset.split_type)
+    key = example_cache_key(name, dataset.split_type, dataset.tokenizer, dataset.args, source=source)
+    path = example_cache_path(cache_dir, name, dataset.split_type, key)
+    mmap = getattr(dataset.args, "example_storage", "memory") == "mmap"
+    dataset.examples = load_examples(path, key, mmap=mmap)
+    if dataset.examples is not None:
+        print("Loaded %d cached examples from %s" % (len(dataset.examples), path))
+        return
+
+    create_examples(dataset, num_workers)
+    save_examples(path, key, dataset.examples)
+    if mmap:
+        dataset.examples = load_examples(path, key, mmap=True)
+
+
+def save_examples(path, key, examples):
+    """ Write examples to the directory `path`: every token sequence goes into one flat int32 array
+        (tokens.npy, split by offsets.npy), the distinct tries into tries.npz and the remaining
+        fields into examples.json, with each distinct knowledge_text stored once. The directory is
+        written elsewhere and renamed into place.
+    """
+    sequences, tries, trie_index, metas = [], [], {}, []
+    knowledge_texts, knowledge_index = [], {}
+    for example in examples:
+        trie = example["trie"]
+        if trie == []:
+            trie_id = -1
+        else:
+            if id(trie) not in trie_index:
+                trie_index[id(trie)] = len(tries)
+                tries.append(trie)
+            trie_id = trie_index[id(trie)]
+        knowledge_text = json.dumps(example["knowledge_text"], ensure_ascii=False)
+        if knowledge_text not in knowledge_index:
+            knowledge_index[knowledge_text] = len(knowledge_texts)
+            knowledge_texts.append(example["knowledge_text"])
+
+        metas.append({
+            "seq": len(sequences),
+            "n_history": len(example["history"]),
+            "trie": trie_id,
+            "task": example["task"],
+            "knowledge_text": knowledge_index[knowledge_text],
+            "response_text": example["response_text"],
+            "dialog_id": example["dialog_id"],
+            "reference_entities": example["reference_entities"],
+        })
+        sequences.extend([example["knowledge"], example["response"]] + example["history"])
+
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seq) for seq in sequences])
+    tokens = np.fromiter((tok for seq in sequences for tok in seq), dtype=np.int32, count=int(offsets[-1]))
+
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    np.save(join(tmp_path, "tokens.npy"), tokens)
+    np.save(join(tmp_path, "offsets.npy"), offsets)
+    save_tries(join(tmp_path, "tries.npz"), tries)
+    with open(join(tmp_path, "examples.json"), "w") as f:
+        json.dump({"key": key, "version": EXAMPLE_CACHE_VERSION, "knowledge_texts": knowledge_texts, "examples": metas},
+                  f, ensure_ascii=False)
+    if exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def load_examples(path, key, mmap=False):
+    """ Examples saved by save_examples, or None if there is no cache for `key`.
+        With mmap=True they come back as a StoredExamples reading the token ids from the mapped files.
+    """
+    if not exists(join(path, "examples.json")):
+        return None
+    with open(join(path, "examples.json")) as f:
+        meta = json.load(f)
+    if meta.get("key") != key or meta.get("version") != EXAMPLE_CACHE_VERSION:
+        return None
+
+    tries = load_tries(join(path, "tries.npz"))
+    knowledge_texts = meta["knowledge_texts"]
+    for example in meta["examples"]:
+        example["trie"] = tries[example["trie"]] if example["trie"] >= 0 else []
+        example["knowledge_text"] = knowledge_texts[example["knowledge_text"]]
+    store = TokenStore(path)
+    if mmap:
+        return StoredExamples(store, meta["examples"])
+
+    sequences = [seq.tolist() for seq in store]
+    examples = []
+    for example in meta["examples"]:
+        seq = example.pop("seq")
+        n_history = example.pop("n_history")
+        example["knowledge"] = sequences[seq]
+        example["response"] = sequences[seq + 1]
+        example["history"] = sequences[seq + 2:seq + 2 + n_history]
+        examples.append(example)
+    return examples
+
+
+def save_tries(filename, tries):
+    """ Concatenate the arrays of ArrayTries, with per-trie node and edge starts to split them again """
+    node_starts = np.cumsum([0] + [len(trie.value_ids) for trie in tries])
+    edge_starts = np.cumsum([0] + [len(trie.child_tokens) for trie in tries])
+    empty = np.zeros(0, dtype=np.int32)
+    np.savez(
+        filename,
+        node_starts=node_starts,
+        edge_starts=edge_starts,
+        offsets=np.concatenate([trie.offsets[:-1] for trie in tries] or [empty]),
+        child_tokens=np.concatenate([trie.child_tokens for trie in tries] or [empty]),
+        value_ids=np.concatenate([trie.value_ids for trie in tries] or [empty]),
+        values=np.array(json.dumps([[trie.value_key, trie.value_list] for trie in tries])),
+    )
+
+
+def load_tries(filename):
+    tries = []
+    with np.load(filename) as f:
+        node_starts, edge_starts = f["node_starts"], f["edge_starts"]
+        offsets, child_tokens, value_ids = f["offsets"], f["child_tokens"], f["value_ids"]
+        values = json.loads(str(f["values"]))
+    for i, (value_key, value_list) in enumerate(values):
+        n_lo, n_hi, e_lo, e_hi = node_starts[i], node_starts[i + 1], edge_starts[i], edge_starts[i + 1]
+        trie = ArrayTrie(value_key=value_key)
+        trie._set_arrays(np.append(offsets[n_lo:n_hi], e_hi - e_lo).astype(np.int32),
+                         child_tokens[e_lo:e_hi].copy(), value_ids[n_lo:n_hi].copy())
+        trie.value_list = value_list
+        tries.append(trie.freeze())
+    return tries
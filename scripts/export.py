@@ -0,0 +1,167 @@
+""" A decoder step of DistilGPT2LMHeadModel with tensors only in and out, for TorchScript and ONNX.
+
+    python -m scripts.export runs/uni-tod/incar runs/uni-tod/incar-export --onnx
+"""
+import argparse
+import os
+
+import torch
+import torch.nn as nn
+
+from .model import DistilGPT2LMHeadModel, KGMaskState, sample_next_token, stack_kg_masks
+
+TORCHSCRIPT_NAME = "decoder_step.pt"
+ONNX_NAME = "decoder_step.onnx"
+INPUT_NAMES = ("input_ids", "token_type_ids", "position_ids", "attention_mask", "past", "kg_weights")
+OUTPUT_NAMES = ("logits", "presents")
+
+
+def kg_mask_weights(kg_mask, vocab_size):
+    """ A single-position kg mask (KGMaskState.kg_mask, stack_kg_masks) as a (rows, vocab) float multiplier:
+        logits * weights is apply_kg_mask (1 for kept logits, 2 for trie ids of a full row, 0 elsewhere)
+    """
+    full, (rows, _, next_toks) = kg_mask
+    weights = full.reshape(-1, 1).float().expand(-1, vocab_size).clone()
+    weights.index_put_((rows, next_toks), torch.ones(len(rows)), accumulate=True)
+    return weights
+
+
+class DecoderStep(nn.Module):
+    """ One token per row through the model: input_ids, token_type_ids and position_ids (batch, 1), the
+        attention_mask (batch, past_length + 1), past (n_layer, 2, batch, head, past_length, head_features)
+        and kg_weights (batch, vocab) from kg_mask_weights. Returns the masked logits (batch, vocab) and
+        the presents, stacked like past. The prompt and the trie walk stay outside, in the eager model and
+        a KGMaskState per row.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.config = model.config
+        self.transformer = model.transformer
+        self.lm_head = model.lm_head
+
+    def forward(self, input_ids, token_type_ids, position_ids, attention_mask, past, kg_weights):
+        hidden_states, presents = self.transformer(
+            input_ids,
+            past=past.unbind(0),
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            use_cache=True,
+        )[:2]
+        logits = self.lm_head(hidden_states[:, -1]) * kg_weights
+        return logits, torch.stack(presents)
+
+
+def example_inputs(model, batch_size=2, past_length=8):
+    config = model.config
+    head_features = config.n_embd // config.n_head
+    return (
+        torch.zeros(batch_size, 1, dtype=torch.long),
+        torch.zeros(batch_size, 1, dtype=torch.long),
+        torch.full((batch_size, 1), past_length, dtype=torch.long),
+        torch.ones(batch_size, past_length + 1, dtype=torch.long),
+        torch.zeros(config.n_layer, 2, batch_size, config.n_head, past_length, head_features),
+        torch.ones(batch_size, config.vocab_size),
+    )
+
+
+def export_torchscript(step, path):
+    step.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(step, example_inputs(step), check_trace=False)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(step, path, opset_version=14):
+    """ ONNX export with dynamic batch size and past length. It goes through the eager attention, which every
+        opset can express.
+    """
+    step.eval()
+    backend = step.transformer.h[0].attn.backend
+    step.transformer.set_attention_backend("eager")
+    dynamic_axes = {
+        "input_ids": {0: "batch"}, "token_type_ids": {0: "batch"}, "position_ids": {0: "batch"},
+        "attention_mask": {0: "batch", 1: "total_length"}, "past": {2: "batch", 4: "past_length"},
+        "kg_weights": {0: "batch"}, "logits": {0: "batch"}, "presents": {2: "batch", 4: "total_length"},
+    }
+    try:
+        with torch.no_grad():
+            torch.onnx.export(step, example_inputs(step), path, input_names=list(INPUT_NAMES),
+                              output_names=list(OUTPUT_NAMES), dynamic_axes=dynamic_axes, opset_version=opset_version)
+    finally:
+        step.transformer.set_attention_backend(backend)
+
+
+class OnnxDecoderStep(object):
+    """ Call an exported decoder_step.onnx like DecoderStep, through onnxruntime """
+
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def __call__(self, *inputs):
+        logits, presents = self.session.run(
+            list(OUTPUT_NAMES), {name: tensor.numpy() for name, tensor in zip(INPUT_NAMES, inputs)})
+        return torch.from_numpy(logits), torch.from_numpy(presents)
+
+
+def run_batch_generation_step(args, model, step, batch, dataset):
+    """ run_batch_generation_incremental (without trie drafts or a prefix cache) with the steps after the prompt
+        run by `step`: a DecoderStep, its TorchScript module or an OnnxDecoderStep. The KGMaskState walk stays
+        here and reaches the step as kg_weights.
+    """
+    special_tokens_ids = args.tokenizer.convert_tokens_to_ids(dataset.SPECIAL_TOKENS_VALUES)
+    current_output = []
+
+    example = batch[0]
+    trie = example["trie"]
+    instance, _ = dataset.build_input_from_segments(example["knowledge"], example["history"], [], trie, example,
+                                                    with_eos=False)
+    response_type = instance["token_type_ids"][-1]
+    kg_state = KGMaskState(trie, instance["input_ids"])
+
+    input_ids = torch.tensor(instance["input_ids"], device=args.device).unsqueeze(0)
+    token_type_ids = torch.tensor(instance["token_type_ids"], device=args.device).unsqueeze(0)
+    logits, past = model(input_ids=input_ids, token_type_ids=token_type_ids, trie=[trie], use_cache=True)[:2]
+    logits, past = logits[0, -1], torch.stack(past)
+
+    i = 0
+    prev = sample_next_token(args, logits, i, special_tokens_ids)
+    while prev not in special_tokens_ids:
+        current_output.append(prev)
+        if i == args.max_length - 1:
+            break
+        kg_state.update(prev)
+        past_length = past.size(-2)
+        logits, past = step(
+            torch.tensor([[prev]], device=args.device),
+            torch.tensor([[response_type]], device=args.device),
+            torch.tensor([[past_length]], device=args.device),
+            torch.ones(1, past_length + 1, dtype=torch.long, device=args.device),
+            past,
+            kg_mask_weights(stack_kg_masks([kg_state.kg_mask()]), logits.size(-1)).to(args.device),
+        )
+        logits = logits[0]
+        i += 1
+        prev = sample_next_token(args, logits, i, special_tokens_ids)
+
+    return current_output, example["response_text"], "", example["reference_entities"], example["knowledge_text"], example["task"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the decoder step of a checkpoint")
+    parser.add_argument("model_name_or_path", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--onnx", action="store_true", help="Also export to ONNX")
+    parser.add_argument("--opset_version", type=int, default=14)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    step = DecoderStep(DistilGPT2LMHeadModel.from_pretrained(args.model_name_or_path))
+    export_torchscript(step, os.path.join(args.output_dir, TORCHSCRIPT_NAME))
+    print("wrote %s" % os.path.join(args.output_dir, TORCHSCRIPT_NAME))
+    if args.onnx:
+        export_onnx(step, os.path.join(args.output_dir, ONNX_NAME), args.opset_version)
+        print("wrote %s" % os.path.join(args.output_dir, ONNX_NAME))
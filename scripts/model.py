@@ -3,10 +3,17 @@ import torch.nn.functional as F
 import logging
 import torch.nn as nn
 import math
+import heapq
+import copy
+import weakref
+import functools
+import contextlib
+from collections import OrderedDict
 from transformers.activations import ACT2FN
 from torch.nn import CrossEntropyLoss
 from transformers.modeling_utils import Conv1D, find_pruneable_heads_and_indices, prune_conv1d_layer
 from transformers.models.gpt2 import GPT2PreTrainedModel
+from .sampling import sample_tokens
 logger = logging.getLogger(__name__)
 
 GPT2_PRETRAINED_MODEL_ARCHIVE_LIST = [
@@ -17,17 +24,502 @@ GPT2_PRETRAINED_MODEL_ARCHIVE_LIST = [
     "distilgpt2",
 ]
 
+## [SKG] ids : 50268, [EKG] ids : 50262
+SKG_ID = 50268
+EKG_ID = 50262
+# positions from here on keep their full logits even without an [EKG] (legacy default of the span end)
+KG_SPAN_LIMIT = 999
+
+
+# (rows, cols, next_toks) of a single position: nothing constrained, only [EKG] allowed
+NO_INDEX = (torch.zeros(0, dtype=torch.long),) * 3
+EKG_INDEX = (torch.zeros(1, dtype=torch.long), torch.zeros(1, dtype=torch.long), torch.tensor([EKG_ID]))
+FULL_POSITION = torch.ones(1, 1, dtype=torch.bool)
+MASKED_POSITION = torch.zeros(1, 1, dtype=torch.bool)
+
+# frozen trie -> {node: single-position index of its children}, built once per node of a (shared) trie
+_node_indices = weakref.WeakKeyDictionary()
+
+
+def _build_node_index(kgtrie, node):
+    next_toks = torch.tensor([int(tok) for tok in kgtrie.next_ids(node)], dtype=torch.long)
+    zeros = torch.zeros(len(next_toks), dtype=torch.long)
+    return zeros, zeros, next_toks
+
+
+def node_index(kgtrie, node):
+    """ The single-position (rows, cols, next_toks) that keeps the trie children of `node`. For a frozen
+        ArrayTrie (TrieCache) it is cached per node, so a step of a KGMaskState or of kg_mask_indices is a
+        dict lookup; any other trie can still gain keys (and an ArrayTrie renumber its nodes), so its index
+        is built on every call. Never modify the tensors.
+    """
+    if not getattr(kgtrie, "frozen", False):
+        return _build_node_index(kgtrie, node)
+    indices = _node_indices.get(kgtrie)
+    if indices is None:
+        indices = _node_indices[kgtrie] = {}
+    index = indices.get(node)
+    if index is None:
+        index = indices[node] = _build_node_index(kgtrie, node)
+    return index
+
+
+def kg_mask_indices(input_ids, trie):
+    """ Find where the KG trie constrains the logits of `input_ids` (batch, seq_len).
+        Positions up to [SKG] and from the first [EKG] on keep their whole logits row (`full`). In between,
+        the logits of the trie children of the prefix emitted since [SKG] are kept (`index`); once the
+        prefix leaves the trie only [EKG] is kept, and nothing is kept after a complete KG entry.
+        Rows whose trie is [] are left unconstrained.
+    """
+    batch_size, seq_len = input_ids.shape
+    full = torch.zeros(batch_size, seq_len, dtype=torch.bool)
+    # one (row, col, allowed ids) per constrained position, the allowed ids come from node_index
+    rows, cols, next_toks = [], [], []
+    for idx, toks in enumerate(input_ids.tolist()):
+        kgtrie = trie[idx]
+        if kgtrie == []:
+            full[idx] = True
+            continue
+
+        st_idx = toks.index(SKG_ID)
+        ed_idx = toks.index(EKG_ID) if EKG_ID in toks else KG_SPAN_LIMIT
+        full[idx, :st_idx + 1] = True
+        full[idx, min(ed_idx, KG_SPAN_LIMIT):] = True
+
+        node = kgtrie.root
+        for idxx in range(st_idx + 1, seq_len):
+            node = kgtrie.child(node, toks[idxx])
+            if node is None:
+                rows.extend([idx] * (seq_len - idxx))
+                cols.extend(range(idxx, seq_len))
+                next_toks.extend([EKG_INDEX[2]] * (seq_len - idxx))
+                break
+            allowed = node_index(kgtrie, node)[2]
+            if len(allowed) == 0:
+                break
+            rows.append(idx)
+            cols.append(idxx)
+            next_toks.append(allowed)
+
+    if not next_toks:
+        return full, NO_INDEX
+    counts = torch.tensor([len(allowed) for allowed in next_toks], dtype=torch.long)
+    index = (torch.tensor(rows, dtype=torch.long).repeat_interleave(counts),
+             torch.tensor(cols, dtype=torch.long).repeat_interleave(counts), torch.cat(next_toks))
+    return full, index
+
+
+def apply_kg_mask(lm_logits, full, index):
+    """ Zero, in place, the logits the trie does not allow in `lm_logits` (batch, seq_len, vocab).
+        A position can be both `full` and trie-constrained (e.g. the [EKG] row after leaving the trie),
+        its allowed logits are then counted twice, as the per-position loop this replaces did.
+    """
+    device = lm_logits.device
+    index = tuple(i.to(device) for i in index)
+    allowed = lm_logits[index]
+    lm_logits.masked_fill_(~full.to(device).unsqueeze(-1), 0)
+    lm_logits.index_put_(index, allowed, accumulate=True)
+    return lm_logits
+
+
+def constrained_cross_entropy(hidden_states, weight, full, index, labels):
+    """ The loss of DistilGPT2LMHeadModel.forward (mean cross-entropy of the kg-masked lm_head logits against
+        the shifted labels) without the (batch, seq_len, vocab) logits. Only positions with a label get
+        logits: the `full` ones through the dense projection, the trie-constrained ones only for their
+        allowed ids, from the gathered rows of `weight`. The vocab - k logits apply_kg_mask leaves at 0
+        on a constrained position still count in its softmax, so the dense and sparse losses match.
+    """
+    device, seq_len, vocab_size = hidden_states.device, labels.size(1), weight.size(0)
+    rows, cols, next_toks = (i.to(device) for i in index)
+    full = full.to(device)
+    targets = torch.full_like(labels, -100)
+    targets[:, :-1] = labels[:, 1:]
+    needed = targets != -100
+
+    dense = full & needed
+    dense_logits = F.linear(hidden_states[dense], weight).float()
+    # allowed ids of a full position are counted twice, as in apply_kg_mask
+    on_dense = dense[rows, cols]
+    if on_dense.any():
+        slot = dense.view(-1).cumsum(0) - 1
+        pos, tok = slot[rows[on_dense] * seq_len + cols[on_dense]], next_toks[on_dense]
+        dense_logits = dense_logits.index_put((pos, tok), dense_logits[pos, tok], accumulate=True)
+    loss = F.cross_entropy(dense_logits, targets[dense], reduction="sum")
+
+    constrained = ~full & needed
+    keep = constrained[rows, cols]
+    rows, cols, next_toks = rows[keep], cols[keep], next_toks[keep]
+    pos = (constrained.view(-1).cumsum(0) - 1)[rows * seq_len + cols]
+    values = (hidden_states[rows, cols] * weight[next_toks]).sum(-1).float()
+    zeros = values.new_zeros(int(constrained.sum()))
+    # logsumexp over the allowed logits and the vocab - k zeros of every constrained position
+    counts = zeros.index_add(0, pos, torch.ones_like(values))
+    top = zeros.scatter_reduce(0, pos, values.detach(), reduce="amax", include_self=True)
+    sums = ((vocab_size - counts) * torch.exp(-top)).index_add(0, pos, torch.exp(values - top[pos]))
+    target_logits = zeros.index_add(0, pos, values * (next_toks == targets[constrained][pos]))
+    loss = loss.float() + (top + torch.log(sums) - target_logits).float().sum()
+    return loss / needed.sum()
+
+
+class KGMaskState(object):
+    """ kg_mask_indices for a single sequence that grows one token at a time: a cursor in the trie.
+        Feed the prompt and then every generated token to `update`; `kg_mask` gives the mask of the
+        logits at the last position fed, in the format DistilGPT2LMHeadModel.forward takes as `kg_mask`.
+        A step moves the cursor by one child and takes the mask of the new node from node_index.
+    """
+
+    def __init__(self, kgtrie, input_ids=()):
+        self.trie = kgtrie
+        self.length = 0
+        self.st_idx = None
+        self.ed_idx = KG_SPAN_LIMIT
+        self.node = None
+        self.index = NO_INDEX
+        for tok in input_ids:
+            self.update(tok)
+
+    @property
+    def next_ids(self):
+        return self.index[2]
+
+    def update(self, tok):
+        idxx = self.length
+        self.length += 1
+        if self.trie == []:
+            return
+        if tok == EKG_ID and idxx < self.ed_idx:
+            self.ed_idx = idxx
+
+        if self.st_idx is None:
+            if tok == SKG_ID:
+                self.st_idx = idxx
+                self.node = self.trie.root
+            return
+        if self.node is None:
+            # left the trie (only [EKG] allowed) or finished a KG entry (nothing allowed), both final
+            return
+        self.node = self.trie.child(self.node, tok)
+        if self.node is None:
+            self.index = EKG_INDEX
+        else:
+            self.index = node_index(self.trie, self.node)
+            if len(self.index[2]) == 0:
+                self.node = None
+
+    def kg_mask(self):
+        idxx = self.length - 1
+        if self.trie == [] or self.st_idx is None:
+            return FULL_POSITION, NO_INDEX
+        full = idxx <= self.st_idx or idxx >= self.ed_idx
+        return (FULL_POSITION if full else MASKED_POSITION), (self.index if idxx > self.st_idx else NO_INDEX)
+
+    def draft(self, limit):
+        """ The tokens (at most limit) the trie forces after the last position fed: while the mask of the
+            next position allows exactly one token, that token. Returns them with the state after each.
+        """
+        tokens, states, state = [], [], self
+        while len(tokens) < limit and state.trie != [] and state.st_idx is not None:
+            idxx = state.length - 1
+            if idxx <= state.st_idx or idxx >= state.ed_idx or len(state.next_ids) != 1:
+                break
+            tokens.append(int(state.next_ids[0]))
+            state = copy.copy(state)
+            state.update(tokens[-1])
+            states.append(state)
+        return tokens, states
+
+
+def stack_kg_masks(kg_masks):
+    """ Merge single-row masks (e.g. KGMaskState.kg_mask of every row of a batch) into one batch mask """
+    full = torch.cat([mask[0] for mask in kg_masks], dim=0)
+    rows = torch.cat([index[0] + row for row, (_, index) in enumerate(kg_masks)])
+    cols = torch.cat([index[1] for _, index in kg_masks])
+    next_toks = torch.cat([index[2] for _, index in kg_masks])
+    return full, (rows, cols, next_toks)
+
+def chain_kg_masks(kg_masks):
+    """ Merge the single-position masks of consecutive positions of one row into the mask of the run """
+    full = torch.cat([mask[0] for mask in kg_masks], dim=1)
+    rows = torch.cat([index[0] for _, index in kg_masks])
+    cols = torch.cat([index[1] + col for col, (_, index) in enumerate(kg_masks)])
+    next_toks = torch.cat([index[2] for _, index in kg_masks])
+    return full, (rows, cols, next_toks)
+
+
+def tail_kg_mask(full, index, start):
+    """ The mask of positions start.. of a kg_mask_indices mask, for logits of only those positions """
+    rows, cols, next_toks = index
+    keep = cols >= start
+    return full[:, start:], (rows[keep], cols[keep] - start, next_toks[keep])
+
+
+class SessionPrefixCache(object):
+    """ Per-session KV cache for GPT2Model: the ids, token types and presents of the last sequence each
+        session (e.g. a conversation) ran. The next prompt of the session reuses the presents of its
+        longest common prefix with that sequence and only runs the rest. Positions are absolute and
+        attention is causal, so a common prefix has exactly the same presents; when history truncation
+        moves the left edge of the prompt the common prefix just gets shorter. Sessions are dropped
+        least recently used first once the presents of all sessions exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        self.reused = 0
+        self.computed = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def lookup(self, session_id, input_ids, token_type_ids):
+        """ (n, past) with the presents of the first n positions, n < len(input_ids); (0, None) on a miss """
+        n = 0
+        entry = self.sessions.get(session_id)
+        if entry is not None:
+            self.sessions.move_to_end(session_id)
+            ids, types, presents, _ = entry
+            limit = min(len(ids), len(input_ids) - 1)
+            while n < limit and ids[n] == input_ids[n] and types[n] == token_type_ids[n]:
+                n += 1
+        self.reused += n
+        self.computed += len(input_ids) - n
+        if n == 0:
+            return 0, None
+        return n, [present[..., :n, :] for present in presents]
+
+    def store(self, session_id, input_ids, token_type_ids, presents):
+        self.evict(session_id)
+        nbytes = sum(present.numel() * present.element_size() for present in presents)
+        if nbytes > self.max_bytes:
+            return
+        self.sessions[session_id] = (list(input_ids), list(token_type_ids), tuple(presents), nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, entry = self.sessions.popitem(last=False)
+            self.nbytes -= entry[3]
+
+    def evict(self, session_id):
+        entry = self.sessions.pop(session_id, None)
+        if entry is not None:
+            self.nbytes -= entry[3]
+
+    def report(self):
+        total = self.reused + self.computed
+        return "Prefix cache: %d sessions, %.1f MB, %d/%d prompt positions reused (%.1f%%)" % (
+            len(self.sessions), self.nbytes / 2 ** 20, self.reused, total, 100.0 * self.reused / max(total, 1))
+
+
+class RadixNode(object):
+    """ An edge of RadixKVCache: its (token id, token type) run and the presents of those positions """
+
+    __slots__ = ("key", "presents", "children", "parent", "last_used", "nbytes")
+
+    def __init__(self, key, presents, parent):
+        self.key = key
+        self.presents = presents
+        self.children = {}
+        self.parent = parent
+        self.last_used = 0
+        self.nbytes = sum(present.numel() * present.element_size() for present in presents)
+
+
+class RadixKVCache(object):
+    """ KV cache for GPT2Model shared by every request: a radix tree over (token id, token type) runs whose
+        edges hold the presents of their positions, so a prompt reuses the presents of its longest
+        prefix cached by any earlier sequence ([BOS] + a common knowledge base, a frequent opening turn).
+        Drop-in for SessionPrefixCache as GPT2Model.prefix_cache; the session_id is not part of the key.
+        Leaves are dropped least recently used first once the presents of all edges exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.root = RadixNode((), [], None)
+        self.nbytes = 0
+        self.n_nodes = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self.computed = 0
+
+    def __len__(self):
+        return self.n_nodes
+
+    @staticmethod
+    def _common_length(key, pairs, start):
+        n, limit = 0, min(len(key), len(pairs) - start)
+        while n < limit and key[n] == pairs[start + n]:
+            n += 1
+        return n
+
+    def match(self, input_ids, token_type_ids):
+        """ (n, past) with the presents of the first n positions, n < len(input_ids); (0, None) on a miss """
+        pairs = list(zip(input_ids, token_type_ids))[:-1]
+        self.clock += 1
+        node, n, path = self.root, 0, []
+        while n < len(pairs):
+            child = node.children.get(pairs[n])
+            if child is None:
+                break
+            m = self._common_length(child.key, pairs, n)
+            child.last_used = self.clock
+            path.append((child, m))
+            n += m
+            if m < len(child.key):
+                break
+            node = child
+        self.reused += n
+        self.computed += len(input_ids) - n
+        if n == 0:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        past = [torch.cat([child.presents[layer][..., :m, :] for child, m in path], dim=-2)
+                for layer in range(len(path[0][0].presents))]
+        return n, past
+
+    def insert(self, input_ids, token_type_ids, presents):
+        """ Cache presents, which cover every position of input_ids """
+        pairs = list(zip(input_ids, token_type_ids))
+        self.clock += 1
+        node, n = self.root, 0
+        while n < len(pairs):
+            child = node.children.get(pairs[n])
+            if child is None:
+                leaf = RadixNode(tuple(pairs[n:]), [present[..., n:, :].clone() for present in presents], node)
+                node.children[pairs[n]] = leaf
+                self._add(leaf)
+                break
+            m = self._common_length(child.key, pairs, n)
+            if m < len(child.key):
+                child = self._split(child, m)
+            child.last_used = self.clock
+            node, n = child, n + m
+        self._evict_to(self.max_bytes)
+
+    def _add(self, node):
+        node.last_used = self.clock
+        self.nbytes += node.nbytes
+        self.n_nodes += 1
+
+    def _split(self, node, m):
+        # node keeps key[m:] under a new parent holding key[:m]; the halves are cloned so that
+        # evicting one of them frees its memory
+        upper = RadixNode(node.key[:m], [present[..., :m, :].clone() for present in node.presents], node.parent)
+        upper.last_used = node.last_used
+        upper.parent.children[upper.key[0]] = upper
+        self.nbytes -= node.nbytes
+        node.key = node.key[m:]
+        node.presents = [present[..., m:, :].clone() for present in node.presents]
+        node.nbytes -= upper.nbytes
+        node.parent = upper
+        upper.children[node.key[0]] = node
+        self.nbytes += node.nbytes
+        self._add(upper)
+        return upper
+
+    def _evict_to(self, max_bytes):
+        if self.nbytes <= max_bytes:
+            return
+        leaves, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append((node.last_used, id(node), node))
+        heapq.heapify(leaves)
+        while self.nbytes > max_bytes and leaves:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.key[0]]
+            self.nbytes -= node.nbytes
+            self.n_nodes -= 1
+            if not parent.children and parent is not self.root:
+                heapq.heappush(leaves, (parent.last_used, id(parent), parent))
+
+    def clear(self):
+        self.root.children.clear()
+        self.nbytes = 0
+        self.n_nodes = 0
+
+    def lookup(self, session_id, input_ids, token_type_ids):
+        return self.match(input_ids, token_type_ids)
+
+    def store(self, session_id, input_ids, token_type_ids, presents):
+        self.insert(input_ids, token_type_ids, presents)
+
+    def report(self):
+        total = self.reused + self.computed
+        return "Radix cache: %d nodes, %.1f MB, %d hits / %d misses, %d/%d prompt positions reused (%.1f%%)" % (
+            self.n_nodes, self.nbytes / 2 ** 20, self.hits, self.misses, self.reused, total,
+            100.0 * self.reused / max(total, 1))
+
+
+def bf16_autocast(args):
+    """ bfloat16 autocast on args.device when args.bf16 is set. Matmuls and projections run in bf16;
+        softmax, LayerNorm (FP32LayerNorm), the residual stream and the losses stay in fp32.
+    """
+    if not getattr(args, "bf16", False):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(args.device).type, dtype=torch.bfloat16)
+
+
+def with_bf16_autocast(fn):
+    """ Run fn(args, ...) under bf16_autocast(args) """
+    @functools.wraps(fn)
+    def wrapper(args, *inputs, **kwargs):
+        with bf16_autocast(args):
+            return fn(args, *inputs, **kwargs)
+    return wrapper
+
+
+def with_attention_backend(fn):
+    """ Run fn(args, model, ...) with the attention backend of args.attention_backend, when it is set """
+    @functools.wraps(fn)
+    def wrapper(args, model, *inputs, **kwargs):
+        backend = getattr(args, "attention_backend", None)
+        if backend is not None and getattr(model.transformer.config, "attention_backend", "eager") != backend:
+            model.transformer.set_attention_backend(backend)
+        return fn(args, model, *inputs, **kwargs)
+    return wrapper
+
+
+class FP32LayerNorm(nn.LayerNorm):
+    """ nn.LayerNorm computed in fp32 whatever the input and parameter dtypes, returned in the input dtype
+        (under bf16_autocast the input is the fp32 residual stream)
+    """
+
+    def forward(self, x):
+        return F.layer_norm(x.float(), self.normalized_shape, self.weight.float(), self.bias.float(), self.eps).to(x.dtype)
+
+
+ATTENTION_BACKENDS = ("eager", "sdpa")
+# buffers every Attention used to register, still found in older checkpoints
+LEGACY_ATTENTION_BUFFERS = ("bias", "masked_bias")
+
+
+def causal_mask(nd, ns, device=None):
+    """ (1, 1, nd, ns) bool: the last nd of ns positions may attend to the keys up to their own """
+    keys = torch.arange(ns, device=device)
+    queries = torch.arange(ns - nd, ns, device=device)
+    return (keys.unsqueeze(0) <= queries.unsqueeze(1)).view(1, 1, nd, ns)
+
+
 class Attention(nn.Module):
-    def __init__(self, nx, n_ctx, config, scale=False):
+    """ GPT-2 attention. Keys, values and the cached presents are all (batch, head, seq_length, head_features).
+        backend "sdpa" runs F.scaled_dot_product_attention (fused flash / memory-efficient kernels), "eager"
+        the explicit softmax(q k^T) v, which is also used whenever the attention weights or a head_mask
+        are asked for. config.attention_backend picks it, eager by default; sdpa is opt-in since its fused
+        kernels do not give bit-identical logits (see with_attention_backend for the args switch).
+    """
+
+    def __init__(self, nx, config, scale=False):
         super().__init__()
 
         n_state = nx  # in Attention: n_state=768 (nx=n_embd)
         # [switch nx => n_state from Block to Attention to keep identical to TF implem]
         assert n_state % config.n_head == 0
-        self.register_buffer(
-            "bias", torch.tril(torch.ones((n_ctx, n_ctx), dtype=torch.uint8)).view(1, 1, n_ctx, n_ctx)
-        )
-        self.register_buffer("masked_bias", torch.tensor(-1e4))
         self.n_head = config.n_head
         self.split_size = n_state
         self.scale = scale
@@ -37,6 +529,21 @@ class Attention(nn.Module):
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
         self.pruned_heads = set()
+        self.set_backend(getattr(config, "attention_backend", "eager"))
+
+    def set_backend(self, backend):
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError("attention backend must be one of %s, got %r" % (ATTENTION_BACKENDS, backend))
+        if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            logger.warning("torch %s has no scaled_dot_product_attention, using eager attention" % torch.__version__)
+            backend = "eager"
+        self.backend = backend
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the causal mask is built on the fly now, drop the buffers of older checkpoints
+        for name in LEGACY_ATTENTION_BUFFERS:
+            state_dict.pop(prefix + name, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def prune_heads(self, heads):
         if len(heads) == 0:
@@ -56,18 +563,21 @@ class Attention(nn.Module):
         self.pruned_heads = self.pruned_heads.union(heads)
 
     def _attn(self, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
-        w = torch.matmul(q, k)
+        if self.backend == "sdpa" and head_mask is None and not output_attentions:
+            return [self._sdpa(q, k, v, attention_mask)]
+
+        w = torch.matmul(q, k.transpose(-2, -1))
         if self.scale:
             w = w / (float(v.size(-1)) ** 0.5)
         nd, ns = w.size(-2), w.size(-1)
-        mask = self.bias[:, :, ns - nd : ns, :ns]
-        w = torch.where(mask.bool(), w, self.masked_bias.to(w.dtype))
+        w = w.masked_fill(~causal_mask(nd, ns, w.device), -1e4)
 
         if attention_mask is not None:
             # Apply the attention mask
             w = w + attention_mask
 
-        w = nn.Softmax(dim=-1)(w)
+        # the scores of bf16 q, k only go through the softmax in fp32
+        w = nn.Softmax(dim=-1)(w.float()).to(v.dtype)
         w = self.attn_dropout(w)
 
         # Mask heads if we want to
@@ -79,19 +589,35 @@ class Attention(nn.Module):
             outputs.append(w)
         return outputs
 
+    def _sdpa(self, q, k, v, attention_mask=None):
+        nd, ns = q.size(-2), k.size(-2)
+        kwargs = {"dropout_p": self.attn_dropout.p if self.training else 0.0}
+        if not self.scale:
+            kwargs["scale"] = 1.0
+        if attention_mask is None and nd == ns:
+            return F.scaled_dot_product_attention(q, k, v, is_causal=True, **kwargs)
+        if nd == 1:
+            # a single new query sees every key, only the padding mask applies
+            mask = attention_mask
+        else:
+            # future keys get -inf where eager puts -1e4, both come out of the softmax as 0
+            causal = causal_mask(nd, ns, q.device)
+            mask = torch.zeros(causal.shape, dtype=q.dtype, device=q.device).masked_fill_(~causal, -float("inf"))
+            if attention_mask is not None:
+                mask = mask + attention_mask
+        if mask is not None:
+            mask = mask.to(q.dtype)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, **kwargs)
 
     def merge_heads(self, x):
         x = x.permute(0, 2, 1, 3).contiguous()
         new_x_shape = x.size()[:-2] + (x.size(-2) * x.size(-1),)
         return x.view(*new_x_shape)  # in Tensorflow implem: fct merge_states
 
-    def split_heads(self, x, k=False):
+    def split_heads(self, x):
         new_x_shape = x.size()[:-1] + (self.n_head, x.size(-1) // self.n_head)
         x = x.view(*new_x_shape)  # in Tensorflow implem: fct split_states
-        if k:
-            return x.permute(0, 2, 3, 1)  # (batch, head, head_features, seq_length)
-        else:
-            return x.permute(0, 2, 1, 3)  # (batch, head, seq_length, head_features)
+        return x.permute(0, 2, 1, 3)  # (batch, head, seq_length, head_features)
 
     def forward(
         self, x, layer_past=None, attention_mask=None, head_mask=None, use_cache=False, output_attentions=False
@@ -99,15 +625,14 @@ class Attention(nn.Module):
         x = self.c_attn(x)
         query, key, value = x.split(self.split_size, dim=2)
         query = self.split_heads(query)
-        key = self.split_heads(key, k=True)
+        key = self.split_heads(key)
         value = self.split_heads(value)
         if layer_past is not None:
-            past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
-            key = torch.cat((past_key, key), dim=-1)
-            value = torch.cat((past_value, value), dim=-2)
+            key = torch.cat((layer_past[0], key), dim=-2)
+            value = torch.cat((layer_past[1], value), dim=-2)
 
         if use_cache is True:
-            present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+            present = torch.stack((key, value))
         else:
             present = (None,)
 
@@ -138,12 +663,12 @@ class MLP(nn.Module):
 
 
 class Block(nn.Module):
-    def __init__(self, n_ctx, config, scale=False):
+    def __init__(self, config, scale=False):
         super().__init__()
         nx = config.n_embd
-        self.ln_1 = nn.LayerNorm(nx, eps=config.layer_norm_epsilon)
-        self.attn = Attention(nx, n_ctx, config, scale)
-        self.ln_2 = nn.LayerNorm(nx, eps=config.layer_norm_epsilon)
+        self.ln_1 = FP32LayerNorm(nx, eps=config.layer_norm_epsilon)
+        self.attn = Attention(nx, config, scale)
+        self.ln_2 = FP32LayerNorm(nx, eps=config.layer_norm_epsilon)
         self.mlp = MLP(4 * nx, config)
 
     def forward(
@@ -168,13 +693,17 @@ class Block(nn.Module):
 
 
 class GPT2Model(GPT2PreTrainedModel):
+    _keys_to_ignore_on_load_unexpected = [r"h\.\d+\.attn\.(masked_)?bias$"]
+
     def __init__(self, config=None):
         super().__init__(config)
         self.wte = nn.Embedding(config.vocab_size, config.n_embd)
         self.wpe = nn.Embedding(config.n_positions, config.n_embd)
         self.drop = nn.Dropout(config.embd_pdrop)
-        self.h = nn.ModuleList([Block(config.n_ctx, config, scale=True) for _ in range(config.n_layer)])
-        self.ln_f = nn.LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
+        self.h = nn.ModuleList([Block(config, scale=True) for _ in range(config.n_layer)])
+        self.ln_f = FP32LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
+        # SessionPrefixCache or RadixKVCache used by forward(session_id=...), off by default
+        self.prefix_cache = None
 
         self.init_weights()
 
@@ -184,6 +713,12 @@ class GPT2Model(GPT2PreTrainedModel):
     def set_input_embeddings(self, new_embeddings):
         self.wte = new_embeddings
 
+    def set_attention_backend(self, backend):
+        """ Switch every Attention to `backend` (see ATTENTION_BACKENDS), kept in the config when saved """
+        for block in self.h:
+            block.attn.set_backend(backend)
+        self.config.attention_backend = backend
+
     def _prune_heads(self, heads_to_prune):
         """ Prunes heads of the model.
             heads_to_prune: dict of {layer_num: list of heads to prune in this layer}
@@ -203,7 +738,13 @@ class GPT2Model(GPT2PreTrainedModel):
         use_cache=None,
         output_attentions=None,
         output_hidden_states=None,
+        session_id=None,
     ):
+        if session_id is not None and self.prefix_cache is not None:
+            if past is not None or attention_mask is not None or position_ids is not None or inputs_embeds is not None:
+                raise ValueError("session_id only takes input_ids and token_type_ids of a whole sequence")
+            return self._forward_session(session_id, input_ids, token_type_ids, head_mask=head_mask,
+                                         output_attentions=output_attentions, output_hidden_states=output_hidden_states)
 
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -318,8 +859,29 @@ class GPT2Model(GPT2PreTrainedModel):
             outputs = outputs + (all_attentions,)
         return outputs  # last hidden state, (presents), (all hidden_states), (attentions)
 
+    def _forward_session(self, session_id, input_ids, token_type_ids=None, **kwargs):
+        """ forward() of one sequence that only runs the positions after the prefix cached for the session,
+            then caches the new presents. The outputs cover the positions that ran (at least the last one).
+        """
+        if input_ids.size(0) != 1:
+            raise ValueError("session_id takes a single sequence, got a batch of %d" % input_ids.size(0))
+        ids = input_ids[0].tolist()
+        types = token_type_ids[0].tolist() if token_type_ids is not None else [-1] * len(ids)
+        n, past = self.prefix_cache.lookup(session_id, ids, types)
+        outputs = self.forward(
+            input_ids[:, n:],
+            past=past,
+            token_type_ids=token_type_ids[:, n:] if token_type_ids is not None else None,
+            use_cache=True,
+            **kwargs
+        )
+        self.prefix_cache.store(session_id, ids, types, outputs[1])
+        return outputs
+
 
 class DistilGPT2LMHeadModel(GPT2PreTrainedModel):
+    _keys_to_ignore_on_load_unexpected = [r"h\.\d+\.attn\.(masked_)?bias$"]
+
     def __init__(self, config=None):
         super().__init__(config=config)
         self.transformer = GPT2Model(config=config)
@@ -348,10 +910,24 @@ class DistilGPT2LMHeadModel(GPT2PreTrainedModel):
         inputs_embeds=None,
         labels=None,
         trie=None,
+        kg_mask=None,
         use_cache=None,
         output_attentions=None,
         output_hidden_states=None,
+        session_id=None,
+        sparse_logits=False,
     ):
+        """ kg_mask, when given, is for the positions of input_ids. With session_id (see
+            GPT2Model.prefix_cache) only the positions after the cached prefix get logits.
+            With sparse_logits the loss comes from constrained_cross_entropy and lm_logits is None.
+        """
+        if labels is not None and session_id is not None:
+            raise ValueError("labels cannot be used with session_id")
+        if sparse_logits and labels is None:
+            raise ValueError("sparse_logits only computes the loss, it needs labels")
+        if sparse_logits and not isinstance(self.lm_head.weight, torch.Tensor):
+            # a dynamic int8 lm_head (scripts.quantization) has no float weight to gather rows from
+            raise ValueError("sparse_logits needs a float lm_head, it cannot run on a quantized model")
 
         transformer_outputs = self.transformer(
             input_ids,
@@ -364,48 +940,20 @@ class DistilGPT2LMHeadModel(GPT2PreTrainedModel):
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
+            session_id=session_id,
         )
         hidden_states = transformer_outputs[0]
 
-        lm_logits = self.lm_head(hidden_states)
-
-
-        end_ids = 50258
-        new_probas = torch.zeros_like(lm_logits)
-        # print('input_ids',input_ids.shape)
-        ## [SKG] ids : 50268, [EKG] ids : 50262
-        for idx, toks in enumerate(input_ids):
-            kgtrie = trie[idx]
-
-            out_ids = []
-            st_idx = (toks == torch.tensor(50268)).nonzero().item()
-            if kgtrie !=[]:
-                for idxx, tok in enumerate(toks):
-                    if idxx >st_idx:
-                        out_ids.append(int(tok))
-                        try:
-                            next_ids = [int(j) for j in kgtrie.next_ones(out_ids)]
-                        except:
-                            next_ids = [50262]
-                        if not next_ids: 
-                            next_ids.append(end_ids)
-                            break
-                        new_probas[idx][idxx][next_ids]+= lm_logits[idx][idxx][next_ids]
-
-                ed_idx = 999
-                for idxxx, tokk in enumerate(toks):
-                    if idxxx <= st_idx:
-                        new_probas[idx][idxxx][:] += lm_logits[idx][idxxx][:]
-                    if tokk == 50262:
-                        ed_idx = idxxx
-                    if idxxx >= ed_idx:
-                        new_probas[idx][idxxx][:]+= lm_logits[idx][idxxx][:]
-            else:
-                new_probas[idx][:][:] += lm_logits[idx][:][:]
-        lm_logits = new_probas
-
-
+        if kg_mask is None:
+            kg_mask = kg_mask_indices(input_ids, trie)
+        if sparse_logits:
+            loss = constrained_cross_entropy(hidden_states, self.lm_head.weight, *kg_mask, labels)
+            return (loss, None) + transformer_outputs[1:]
 
+        lm_logits = self.lm_head(hidden_states)
+        if session_id is not None and lm_logits.size(1) < input_ids.size(-1):
+            kg_mask = tail_kg_mask(*kg_mask, input_ids.size(-1) - lm_logits.size(1))
+        lm_logits = apply_kg_mask(lm_logits, *kg_mask)
 
         outputs = (lm_logits,) + transformer_outputs[1:]
         if labels is not None:
@@ -416,7 +964,7 @@ class DistilGPT2LMHeadModel(GPT2PreTrainedModel):
             # print('shift_labels',shift_labels.shape)
             # Flatten the tokens
             loss_fct = CrossEntropyLoss()
-            loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+            loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)).float(), shift_labels.view(-1))
             outputs = (loss,) + outputs
             # exit()
 
@@ -424,12 +972,15 @@ class DistilGPT2LMHeadModel(GPT2PreTrainedModel):
 
 
 
+@with_attention_backend
+@with_bf16_autocast
 def run_batch_generation(args, model, batch):
     trie = batch[-1]
     batch = tuple(input_tensor.to(args.device).long() for input_tensor in batch[:-1])
     input_ids, token_type_ids, pos_ids, lm_labels = batch
 
-    model_outputs = model(input_ids=input_ids, token_type_ids=token_type_ids, position_ids=None, labels=lm_labels, trie=trie)
+    model_outputs = model(input_ids=input_ids, token_type_ids=token_type_ids, position_ids=None, labels=lm_labels, trie=trie,
+                          sparse_logits=getattr(args, "sparse_logits", False))
     loss = model_outputs[0]
     lm_logits = model_outputs[1]
     return loss, lm_logits, torch.tensor([]), torch.tensor([])
@@ -476,7 +1027,34 @@ def get_dialogue_accuracy(args, outputs):
     pass
 
 
+def sample_batch_tokens(args, logits, i, special_tokens_ids):
+    """ The next token (batch,) of every row of logits (batch, vocab) at step i. Under min_length the
+        special tokens are masked out instead of resampled. top_k/top_p only apply with
+        args.top_filtering, generation used to leave them out.
+    """
+    filtering = getattr(args, "top_filtering", False)
+    return sample_tokens(
+        logits,
+        args.temperature,
+        top_k=args.top_k if filtering else 0,
+        top_p=args.top_p if filtering else 0.0,
+        no_sample=args.no_sample,
+        banned_ids=special_tokens_ids if i < args.min_length else None,
+    )
+
+
+def sample_next_token(args, logits, i, special_tokens_ids):
+    return sample_batch_tokens(args, logits.unsqueeze(0), i, special_tokens_ids)[0].item()
+
+
+@with_attention_backend
+@with_bf16_autocast
 def run_batch_generation_sample(args, model, batch, dataset):
+    if getattr(args, "num_beams", 1) > 1:
+        return run_batch_generation_beam(args, model, batch, dataset)[0]
+    if getattr(args, "use_cache", False):
+        return run_batch_generation_incremental(args, model, batch, dataset)
+
     special_tokens_ids = args.tokenizer.convert_tokens_to_ids(dataset.SPECIAL_TOKENS_VALUES)
     current_output = []
 
@@ -494,28 +1072,315 @@ def run_batch_generation_sample(args, model, batch, dataset):
         model_outputs = model(input_ids=input_ids,  token_type_ids=token_type_ids, position_ids=None, trie=[trie])
         logits = model_outputs[0]
 
+        prev = sample_next_token(args, logits[0, -1, :], i, special_tokens_ids)
+        if prev in special_tokens_ids:
+            break
+        current_output.append(prev)
+
+    return current_output, response_text, "", ref_entities, knowledge_text, task
 
-        logits = logits[0, -1, :] / args.temperature
-        # print('args.temperature',args.temperature)
-        # logits = top_filtering(logits, top_k=args.top_k, top_p=args.top_p)
-        probs = F.softmax(logits, dim=-1)
-        prev = torch.topk(probs, 1)[1] if args.no_sample else torch.multinomial(probs, 1)
 
-        if i < args.min_length and prev.item() in special_tokens_ids:
-            while prev.item() in special_tokens_ids:
-                if probs.max().item() == 1:
-                    logger.warning("Warning: model generating special token with probability 1! Breaking...")
-                    break
-                prev = torch.multinomial(probs, num_samples=1)
+@with_attention_backend
+@with_bf16_autocast
+def run_batch_generation_incremental(args, model, batch, dataset):
+    """ run_batch_generation_sample with a KV cache: the knowledge + history prompt goes through the model
+        once, then every step feeds only the last sampled token together with `past`, and the trie mask
+        of the new position comes from a KGMaskState instead of re-walking the whole response.
+        With args.trie_drafts, the tokens the trie forces after the last one (KGMaskState.draft) are fed
+        along with it and kept as long as sampling picks them, so a forced run of a KG entity takes one
+        forward pass instead of one per token and the output stays that of step-by-step decoding.
+        With model.transformer.prefix_cache set, the prompt reuses the presents of the previous turn
+        of the same dialog_id (any cached prefix with a RadixKVCache) and the presents of this turn are
+        cached for the next one.
+    """
+    special_tokens_ids = args.tokenizer.convert_tokens_to_ids(dataset.SPECIAL_TOKENS_VALUES)
+    current_output = []
+
+    example = batch[0]
+    ref_entities, knowledge, knowledge_text, history, task = example["reference_entities"],  example["knowledge"], example["knowledge_text"], example["history"], example['task']
+    trie = example["trie"]
+    response_text = example["response_text"]
+    if args.max_length <= 0:
+        # the step loop samples a token before it checks max_length
+        return current_output, response_text, "", ref_entities, knowledge_text, task
+
+    instance, sequence = dataset.build_input_from_segments(knowledge, history, [], trie, example, with_eos=False)
+    # generated tokens belong to the response segment, which has the type of its speaker token
+    response_type = instance["token_type_ids"][-1]
+    kg_state = KGMaskState(trie, instance["input_ids"])
+
+    prefix_cache = model.transformer.prefix_cache
+    session_id = example["dialog_id"] if prefix_cache is not None else None
+
+    input_ids = torch.tensor(instance["input_ids"], device=args.device).unsqueeze(0)
+    token_type_ids = torch.tensor(instance["token_type_ids"], device=args.device).unsqueeze(0)
+    # the prompt pass only needs the logits of its last position, whose mask is the one kg_state holds
+    hidden_states, past = model.transformer(input_ids=input_ids, token_type_ids=token_type_ids, use_cache=True,
+                                            session_id=session_id)[:2]
+    logits = apply_kg_mask(model.lm_head(hidden_states[:, -1:]), *kg_state.kg_mask())
+
+    use_drafts = getattr(args, "trie_drafts", False)
+    i = 0
+    prev = sample_next_token(args, logits[0, -1, :], i, special_tokens_ids)
+    while prev not in special_tokens_ids:
+        current_output.append(prev)
+        if i == args.max_length - 1:
+            break
 
-        if prev.item() in special_tokens_ids:
+        kg_state.update(prev)
+        draft, draft_states = kg_state.draft(args.max_length - 1 - i) if use_drafts else ([], [])
+        states = [kg_state] + draft_states
+        input_ids = torch.tensor([[prev] + draft], device=args.device)
+        token_type_ids = torch.full_like(input_ids, response_type)
+        model_outputs = model(input_ids=input_ids, token_type_ids=token_type_ids, past=past,
+                              kg_mask=chain_kg_masks([state.kg_mask() for state in states]), use_cache=True)
+        logits, past = model_outputs[0], model_outputs[1]
+
+        # the trie draft is checked by sampling each of its positions as step-by-step decoding would:
+        # every draft token sampled anyway is accepted, the first other token is decoded as usual
+        accepted, finished = 0, False
+        i += 1
+        prev = sample_next_token(args, logits[0, 0, :], i, special_tokens_ids)
+        while accepted < len(draft) and prev == draft[accepted] and prev not in special_tokens_ids:
+            current_output.append(prev)
+            accepted += 1
+            if i == args.max_length - 1:
+                finished = True
+                break
+            i += 1
+            prev = sample_next_token(args, logits[0, accepted, :], i, special_tokens_ids)
+        kg_state = states[accepted]
+        if accepted < len(draft):
+            past = [layer_past[..., :accepted - len(draft), :] for layer_past in past]
+        if finished:
             break
-        current_output.append(prev.item())
+
+    if session_id is not None:
+        # past covers the prompt and the generated tokens fed back so far
+        n_fed = past[0].size(-2) - len(instance["input_ids"])
+        prefix_cache.store(session_id, instance["input_ids"] + current_output[:n_fed],
+                           instance["token_type_ids"] + [response_type] * n_fed, past)
 
     return current_output, response_text, "", ref_entities, knowledge_text, task
 
 
 
+def generation_step(model, input_ids, token_type_ids, position_ids, attention_mask, past, kg_mask):
+    """ One decoding step for a batch: logits (batch, vocab) of the last position, masked with `kg_mask`
+        (stack_kg_masks of the per-row KGMaskState), and the new presents. Only the last position goes
+        through lm_head.
+    """
+    transformer_outputs = model.transformer(
+        input_ids,
+        past=past,
+        attention_mask=attention_mask,
+        token_type_ids=token_type_ids,
+        position_ids=position_ids,
+        use_cache=True,
+    )
+    hidden_states, presents = transformer_outputs[:2]
+    lm_logits = model.lm_head(hidden_states[:, -1:])
+    lm_logits = apply_kg_mask(lm_logits, *kg_mask)
+    return lm_logits[:, -1].float(), presents
+
+
+def pad_prompts(instances, pad, device):
+    """ Left-pad the prompts of build_input_from_segments instances into one batch: input_ids, token_type_ids,
+        attention_mask, position_ids (counted from the first real token) and the position of the next token
+    """
+    lengths = [len(instance["input_ids"]) for instance in instances]
+    max_len = max(lengths)
+    input_ids = torch.tensor(
+        [[pad] * (max_len - length) + instance["input_ids"] for length, instance in zip(lengths, instances)],
+        device=device)
+    token_type_ids = torch.tensor(
+        [[pad] * (max_len - length) + instance["token_type_ids"] for length, instance in zip(lengths, instances)],
+        device=device)
+    attention_mask = torch.tensor([[0] * (max_len - length) + [1] * length for length in lengths], device=device)
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    return input_ids, token_type_ids, attention_mask, position_ids, torch.tensor(lengths, device=device)
+
+
+@with_attention_backend
+@with_bf16_autocast
+def run_batch_generation_batched(args, model, batch, dataset):
+    """ Decode every example of an EvalDataset batch at once, returning one run_batch_generation_sample
+        tuple per example. Prompts are left-padded and masked, every row keeps its own KGMaskState and
+        rows leave the batch (and the KV cache) as soon as they emit a special token.
+    """
+    special_tokens_ids = args.tokenizer.convert_tokens_to_ids(dataset.SPECIAL_TOKENS_VALUES)
+    current_outputs = [[] for _ in batch]
+
+    instances = [
+        dataset.build_input_from_segments(example["knowledge"], example["history"], [], example["trie"], example, with_eos=False)[0]
+        for example in batch
+    ]
+    kg_states = [KGMaskState(example["trie"], instance["input_ids"]) for example, instance in zip(batch, instances)]
+    response_types = torch.tensor([instance["token_type_ids"][-1] for instance in instances], device=args.device)
+    input_ids, token_type_ids, attention_mask, position_ids, next_positions = pad_prompts(instances, dataset.pad, args.device)
+
+    active = list(range(len(batch)))
+    logits, past = generation_step(model, input_ids, token_type_ids, position_ids, attention_mask, None,
+                                   stack_kg_masks([state.kg_mask() for state in kg_states]))
+
+    for i in range(args.max_length):
+        keep = []
+        for row, (j, prev) in enumerate(zip(active, sample_batch_tokens(args, logits, i, special_tokens_ids).tolist())):
+            if prev in special_tokens_ids:
+                continue
+            current_outputs[j].append(prev)
+            kg_states[j].update(prev)
+            keep.append(row)
+        if not keep or i == args.max_length - 1:
+            break
+
+        if len(keep) < len(active):
+            keep_index = torch.tensor(keep, device=args.device)
+            past = [layer_past.index_select(1, keep_index) for layer_past in past]
+            attention_mask = attention_mask.index_select(0, keep_index)
+            response_types = response_types.index_select(0, keep_index)
+            next_positions = next_positions.index_select(0, keep_index)
+            active = [active[row] for row in keep]
+
+        input_ids = torch.tensor([[current_outputs[j][-1]] for j in active], device=args.device)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(len(active), 1)], dim=1)
+        logits, past = generation_step(model, input_ids, response_types.unsqueeze(-1), next_positions.unsqueeze(-1),
+                                       attention_mask, past, stack_kg_masks([kg_states[j].kg_mask() for j in active]))
+        next_positions = next_positions + 1
+
+    return [
+        (current_outputs[j], example["response_text"], "", example["reference_entities"], example["knowledge_text"], example["task"])
+        for j, example in enumerate(batch)
+    ]
+
+
+def kg_allowed_tokens(kg_mask, vocab_size):
+    """ (rows, vocab) bool of the tokens a single-position kg mask (e.g. stack_kg_masks) allows: every token
+        outside the KG span, the trie children inside it, and only [EKG] once a KG entry is complete.
+        apply_kg_mask zeroes the other logits, this excludes them.
+    """
+    full, (rows, _, next_toks) = kg_mask
+    allowed = full.reshape(-1, 1).expand(-1, vocab_size).clone()
+    allowed[rows, next_toks] = True
+    allowed[~allowed.any(-1), EKG_ID] = True
+    return allowed
+
+
+def add_hypothesis(hyps, tokens, score, num_beams, length_penalty):
+    """ Keep the num_beams best (score / length ** length_penalty, tokens) of an example """
+    hyps.append((score / max(len(tokens), 1) ** length_penalty, tokens))
+    hyps.sort(key=lambda hyp: hyp[0], reverse=True)
+    del hyps[num_beams:]
+
+
+@with_attention_backend
+@with_bf16_autocast
+def run_batch_generation_beam(args, model, batch, dataset):
+    """ Beam search over every example of an EvalDataset batch, returning one run_batch_generation_sample
+        tuple per example. Each example has args.num_beams rows in the batch; a step picks the next beams
+        of an example with one topk over its flattened beam x vocab log-probabilities and reorders `past`
+        with index_select. Inside the [SKG]/[EKG] span only kg_allowed_tokens can be chosen. A beam ends on
+        a special token. An example is done once it has num_beams hypotheses and, unless
+        args.early_stopping, no live beam can still beat the worst of them (args.length_penalty applies).
+    """
+    num_beams = args.num_beams
+    length_penalty = getattr(args, "length_penalty", 1.0)
+    early_stopping = getattr(args, "early_stopping", False)
+    special_tokens_ids = args.tokenizer.convert_tokens_to_ids(dataset.SPECIAL_TOKENS_VALUES)
+    stop_ids = set(special_tokens_ids)
+    special = torch.tensor(sorted(stop_ids), device=args.device)
+
+    instances = [
+        dataset.build_input_from_segments(example["knowledge"], example["history"], [], example["trie"], example, with_eos=False)[0]
+        for example in batch
+    ]
+    prompt_states = [KGMaskState(example["trie"], instance["input_ids"]) for example, instance in zip(batch, instances)]
+    response_types = torch.tensor([instance["token_type_ids"][-1] for instance in instances], device=args.device)
+    input_ids, token_type_ids, attention_mask, position_ids, next_positions = pad_prompts(instances, dataset.pad, args.device)
+    logits, past = generation_step(model, input_ids, token_type_ids, position_ids, attention_mask, None,
+                                   stack_kg_masks([state.kg_mask() for state in prompt_states]))
+
+    # the prompt runs once per example and is copied to its beams, of which only the first starts live
+    index = torch.arange(len(batch), device=args.device).repeat_interleave(num_beams)
+    logits = logits.index_select(0, index)
+    past = [layer_past.index_select(1, index) for layer_past in past]
+    attention_mask = attention_mask.index_select(0, index)
+    response_types = response_types.index_select(0, index)
+    next_positions = next_positions.index_select(0, index)
+    kg_states = [copy.copy(prompt_states[j]) for j in index.tolist()]
+    beam_scores = torch.full((len(batch), num_beams), -float("inf"), device=args.device)
+    beam_scores[:, 0] = 0
+    beam_scores = beam_scores.view(-1)
+    tokens = torch.zeros(len(batch) * num_beams, 0, dtype=torch.long, device=args.device)
+    vocab_size = logits.size(-1)
+
+    hyps = [[] for _ in batch]
+    done = [False] * len(batch)
+    kg_mask = stack_kg_masks([state.kg_mask() for state in kg_states])
+    for i in range(args.max_length):
+        log_probs = F.log_softmax(logits, dim=-1).masked_fill(~kg_allowed_tokens(kg_mask, vocab_size).to(logits.device), -float("inf"))
+        if i < args.min_length:
+            log_probs[:, special] = -float("inf")
+        scores = (beam_scores.unsqueeze(-1) + log_probs).view(len(batch), -1)
+        top_scores, top_index = scores.topk(2 * num_beams, dim=-1)
+        top_rows = torch.div(top_index, vocab_size, rounding_mode="floor") + num_beams * torch.arange(
+            len(batch), device=args.device).unsqueeze(-1)
+        top_tokens = top_index % vocab_size
+
+        rows, next_tokens, next_scores = [], [], []
+        for j, (cand_scores, cand_rows, cand_tokens) in enumerate(zip(top_scores.tolist(), top_rows.tolist(), top_tokens.tolist())):
+            beams = []
+            if not done[j]:
+                for rank, (score, row, tok) in enumerate(zip(cand_scores, cand_rows, cand_tokens)):
+                    if score == -float("inf") or len(beams) == num_beams:
+                        break
+                    if tok in stop_ids:
+                        if rank < num_beams:
+                            add_hypothesis(hyps[j], tokens[row].tolist(), score, num_beams, length_penalty)
+                        continue
+                    beams.append((row, tok, score))
+            # finished examples and examples with too few candidates fill their rows with dead beams
+            beams += [(j * num_beams, dataset.pad, -float("inf"))] * (num_beams - len(beams))
+            best = beams[0][2]
+            if not done[j]:
+                done[j] = best == -float("inf") or (len(hyps[j]) == num_beams and (
+                    early_stopping or best / (i + 1) ** length_penalty <= hyps[j][-1][0]))
+            for row, tok, score in beams:
+                rows.append(row)
+                next_tokens.append(tok)
+                next_scores.append(score)
+
+        index = torch.tensor(rows, device=args.device)
+        tokens = torch.cat([tokens.index_select(0, index), torch.tensor(next_tokens, device=args.device).unsqueeze(-1)], dim=1)
+        beam_scores = torch.tensor(next_scores, device=args.device)
+        kg_states = [copy.copy(kg_states[row]) for row in rows]
+        if all(done) or i == args.max_length - 1:
+            break
+
+        for state, tok in zip(kg_states, next_tokens):
+            state.update(tok)
+        kg_mask = stack_kg_masks([state.kg_mask() for state in kg_states])
+        past = [layer_past.index_select(1, index) for layer_past in past]
+        attention_mask = torch.cat([attention_mask.index_select(0, index), attention_mask.new_ones(len(rows), 1)], dim=1)
+        logits, past = generation_step(model, tokens[:, -1:], response_types.unsqueeze(-1), next_positions.unsqueeze(-1),
+                                       attention_mask, past, kg_mask)
+        next_positions = next_positions + 1
+
+    # beams still live at max_length compete with the finished hypotheses
+    for j in range(len(batch)):
+        if done[j]:
+            continue
+        for row in range(j * num_beams, (j + 1) * num_beams):
+            if beam_scores[row].item() > -float("inf"):
+                add_hypothesis(hyps[j], tokens[row].tolist(), beam_scores[row].item(), num_beams, length_penalty)
+
+    return [
+        (hyps[j][0][1] if hyps[j] else [], example["response_text"], "", example["reference_entities"],
+         example["knowledge_text"], example["task"])
+        for j, example in enumerate(batch)
+    ]
+
+
 class PositionalEmbedding(nn.Module):
 
     def __init__(self, d_model, max_len=1024):
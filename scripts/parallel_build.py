@@ -0,0 +1,78 @@
+import multiprocessing
+
+from .trie import TrieCache
+
+
+# the dataset a pool worker builds shards of, set by _init_worker (inherited as is under fork)
+_dataset = None
+
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def _build_shard(bounds):
+    start, end = bounds
+    dialogs = _dataset.dialogs
+    _dataset.dialogs = dialogs[start:end]
+    try:
+        _dataset._create_examples()
+    finally:
+        _dataset.dialogs = dialogs
+    return _dataset.examples, _dataset.trie_cache
+
+
+def shard_bounds(n, num_shards):
+    """ Contiguous [start, end) ranges splitting n dialogs into num_shards shards of near-equal size """
+    step, extra = divmod(n, num_shards)
+    bounds, start = [], 0
+    for i in range(num_shards):
+        end = start + step + (1 if i < extra else 0)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def merge_shards(results):
+    """ Concatenate the (examples, trie_cache) of each shard in shard order. Tries are interned across
+        shards by their TrieCache key, so examples share tries and the cache counts hits exactly as
+        in a serial build.
+    """
+    examples, cache = [], TrieCache()
+    for shard_examples, shard_cache in results:
+        cache.hits += shard_cache.hits
+        cache.misses += shard_cache.misses
+        cache.bytes_saved += shard_cache.bytes_saved
+        interned = {}
+        for key, trie in shard_cache.tries.items():
+            if key in cache.tries:
+                cache.misses -= 1
+                cache.hits += 1
+                cache.bytes_saved += trie.nbytes
+            else:
+                # unpickled arrays come back writeable
+                cache.tries[key] = trie.freeze()
+            interned[id(trie)] = cache.tries[key]
+        for example in shard_examples:
+            if example["trie"] != []:
+                example["trie"] = interned[id(example["trie"])]
+            examples.append(example)
+    return examples, cache
+
+
+def create_examples(dataset, num_workers=1, shards_per_worker=4):
+    """ dataset._create_examples(), with the dialogs split into contiguous shards that a pool of
+        num_workers processes builds. Every example only depends on its own dialog, so the merged
+        result is the same as the serial one for any number of workers.
+    """
+    if num_workers <= 1 or len(dataset.dialogs) < num_workers:
+        dataset._create_examples()
+        return
+
+    bounds = shard_bounds(len(dataset.dialogs), num_workers * shards_per_worker)
+    print("Creating examples in %d shards on %d processes" % (len(bounds), num_workers))
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(dataset,)) as pool:
+        results = pool.map(_build_shard, bounds, chunksize=1)
+    dataset.examples, dataset.trie_cache = merge_shards(results)
+    print(dataset.trie_cache.report())
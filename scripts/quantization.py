@@ -0,0 +1,76 @@
+""" Dynamic int8 inference for DistilGPT2LMHeadModel on CPU.
+
+    python -m scripts.quantization runs/uni-tod/incar runs/uni-tod/incar-int8
+"""
+import argparse
+import os
+import shutil
+
+import torch
+import torch.nn as nn
+from transformers.modeling_utils import Conv1D
+
+from .model import DistilGPT2LMHeadModel
+
+QUANTIZED_WEIGHTS_NAME = "quantized_model.bin"
+# files of a checkpoint directory copied along with the quantized weights (tokenizer, config)
+CHECKPOINT_FILES = ("config.json", "vocab.json", "merges.txt", "special_tokens_map.json", "added_tokens.json",
+                    "tokenizer_config.json")
+
+
+def conv1d_to_linear(conv):
+    """ The nn.Linear computing the same as a transformers Conv1D (weight (in, out), x @ weight + bias) """
+    linear = nn.Linear(conv.weight.size(0), conv.weight.size(1))
+    linear.weight.data = conv.weight.data.t().contiguous()
+    linear.bias.data = conv.bias.data.clone()
+    return linear
+
+
+def quantize_int8(model):
+    """ Replace the c_attn/c_proj/c_fc Conv1D projections of every block by nn.Linear, then quantize them and
+        lm_head to int8 with per output channel scales (activations are quantized per batch at run time).
+        The embeddings, layer norms and the trie masking of the logits stay float. Works in place.
+        The result is for inference: forward(sparse_logits=True) needs the float lm_head weight.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                setattr(module, name, conv1d_to_linear(child))
+    model.eval()
+    return torch.quantization.quantize_dynamic(
+        model, {nn.Linear: torch.quantization.per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=True)
+
+
+def save_quantized(model, source_dir, output_dir):
+    """ Save a quantize_int8 model with the config and tokenizer files of the checkpoint it came from """
+    os.makedirs(output_dir, exist_ok=True)
+    for name in CHECKPOINT_FILES:
+        if os.path.exists(os.path.join(source_dir, name)):
+            shutil.copy(os.path.join(source_dir, name), output_dir)
+    if not os.path.exists(os.path.join(output_dir, "config.json")):
+        model.config.save_pretrained(output_dir)
+    torch.save(model.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+
+
+def load_model(model_name_or_path):
+    """ DistilGPT2LMHeadModel.from_pretrained, or the int8 model of a directory written by save_quantized """
+    weights = os.path.join(model_name_or_path, QUANTIZED_WEIGHTS_NAME)
+    if not os.path.exists(weights):
+        return DistilGPT2LMHeadModel.from_pretrained(model_name_or_path)
+    config = DistilGPT2LMHeadModel.config_class.from_pretrained(model_name_or_path)
+    model = quantize_int8(DistilGPT2LMHeadModel(config))
+    model.load_state_dict(torch.load(weights, map_location="cpu"))
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a fine-tuned checkpoint to dynamic int8")
+    parser.add_argument("model_name_or_path", type=str)
+    parser.add_argument("output_dir", type=str)
+    args = parser.parse_args()
+
+    model = DistilGPT2LMHeadModel.from_pretrained(args.model_name_or_path)
+    fp32_bytes = sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values())
+    save_quantized(quantize_int8(model), args.model_name_or_path, args.output_dir)
+    print("%s: %.1f MB of fp32 weights -> %.1f MB" % (
+        args.output_dir, fp32_bytes / 2 ** 20, os.path.getsize(os.path.join(args.output_dir, QUANTIZED_WEIGHTS_NAME)) / 2 ** 20))
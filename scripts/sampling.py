@@ -0,0 +1,64 @@
+import torch
+import torch.nn.functional as F
+
+
+def filter_logits(logits, top_k=0, top_p=0.0, threshold=-float("inf")):
+    """ top_filtering for a batch of logits (batch, vocab) without touching the whole vocabulary twice.
+        Returns the candidates of every row, (values, indices) sorted by decreasing logit, with the
+        filtered-out values set to -inf. With top_k the candidates are the topk slice and top-p only
+        looks at it (the softmax over the slice equals the one over the top-k filtered vocabulary);
+        without top_k the row is sorted once. The best candidate always survives the threshold.
+    """
+    if 0 < top_k < logits.size(-1):
+        values, indices = logits.topk(top_k, dim=-1)
+    else:
+        values, indices = logits.sort(dim=-1, descending=True)
+
+    if top_p > 0.0:
+        cumulative_probabilities = F.softmax(values, dim=-1).cumsum(dim=-1)
+        # keep the first candidate above top_p as well
+        remove = cumulative_probabilities > top_p
+        remove = torch.cat([remove.new_zeros(remove.size(0), 1), remove[:, :-1]], dim=-1)
+        values = values.masked_fill(remove, -float("inf"))
+
+    if threshold > -float("inf"):
+        remove = values < threshold
+        remove[:, 0] = False
+        values = values.masked_fill(remove, -float("inf"))
+    return values, indices
+
+
+def mask_tokens(logits, token_ids, rows=None):
+    """ Set the logits of token_ids to -inf, in every row or in the rows where `rows` (bool, batch) is set.
+        A row left without any finite logit keeps its logits, as sample_next_token gives up resampling
+        when a special token has probability 1.
+    """
+    banned = torch.zeros(logits.size(-1), dtype=torch.bool, device=logits.device)
+    banned[token_ids] = True
+    banned = banned.unsqueeze(0)
+    if rows is not None:
+        banned = banned & rows.to(logits.device).unsqueeze(-1)
+    masked = logits.masked_fill(banned, -float("inf"))
+    stuck = torch.isinf(masked).all(dim=-1, keepdim=True)
+    return torch.where(stuck, logits, masked)
+
+
+def sample_tokens(logits, temperature=1.0, top_k=0, top_p=0.0, threshold=-float("inf"), no_sample=False,
+                  banned_ids=None, banned_rows=None):
+    """ One next token (batch,) for every row of logits (batch, vocab): temperature, then banned_ids masked
+        (e.g. the special tokens of rows under min_length, see mask_tokens), then filter_logits, then the
+        argmax (no_sample) or a draw from the softmax of the candidates left. Without any filter the
+        vocabulary is not sorted at all.
+    """
+    logits = logits.float() / temperature
+    if banned_ids is not None:
+        logits = mask_tokens(logits, banned_ids, banned_rows)
+    if top_k > 0 or top_p > 0.0 or threshold > -float("inf"):
+        values, indices = filter_logits(logits, top_k=top_k, top_p=top_p, threshold=threshold)
+    else:
+        values, indices = logits, None
+    if no_sample:
+        choice = values.argmax(dim=-1, keepdim=True)
+    else:
+        choice = torch.multinomial(F.softmax(values, dim=-1), 1)
+    return choice.squeeze(-1) if indices is None else indices.gather(-1, choice).squeeze(-1)
@@ -0,0 +1,65 @@
+from os.path import join
+
+import numpy as np
+
+
+class TokenStore(object):
+    """ The token sequences of an example cache entry: tokens.npy holds all of them back to back as
+        int32 and offsets.npy where each one starts. Both are memory-mapped read-only, so every process
+        reading the same entry (e.g. DataLoader workers) shares their pages. Pickling keeps only the path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self.tokens = np.load(join(self.path, "tokens.npy"), mmap_mode="r")
+        self.offsets = np.load(join(self.path, "offsets.npy"), mmap_mode="r")
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class StoredExamples(object):
+    """ Stands in for the examples list of a dataset. The knowledge, response and history token ids are
+        sliced out of a TokenStore when an example is accessed, only the text fields and the (shared)
+        tries are kept as Python objects.
+    """
+
+    def __init__(self, store, metas):
+        self.store = store
+        self.seq = np.array([meta.pop("seq") for meta in metas], dtype=np.int64)
+        self.n_history = np.array([meta.pop("n_history") for meta in metas], dtype=np.int32)
+        self.metas = metas
+
+    def __len__(self):
+        return len(self.metas)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        seq, n_history = int(self.seq[index]), int(self.n_history[index])
+        example = dict(self.metas[index])
+        example["knowledge"] = self.store[seq].tolist()
+        example["response"] = self.store[seq + 1].tolist()
+        example["history"] = [self.store[i].tolist() for i in range(seq + 2, seq + 2 + n_history)]
+        return example
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
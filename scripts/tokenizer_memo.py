@@ -0,0 +1,115 @@
+import re
+
+
+class TokenizerMemo(object):
+    """ Memoized tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)).
+
+        `prime` tokenizes all unseen strings in batches through the Rust backend of the tokenizer, so the
+        dataset build collects its strings first and then only does dict lookups. A fast tokenizer is used
+        as is. A slow GPT2Tokenizer is converted to a backend once; since the slow tokenizer cuts out the
+        special tokens and strips the whitespace around them before BPE (the fast one does not), that split
+        is done here and only the plain chunks go through the backend, which keeps the ids unchanged.
+    """
+
+    def __init__(self, tokenizer, batch_size=4096):
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.memo = {}
+        self.chunks = {}
+        self.last_history = []
+        self.last_ids = []
+        self.backend = None
+        if getattr(tokenizer, "is_fast", False):
+            return
+        if getattr(tokenizer, "add_prefix_space", False):
+            # the converted backend would add the space to every chunk instead of once per text
+            return
+        try:
+            from transformers.convert_slow_tokenizer import convert_slow_tokenizer
+            self.backend = convert_slow_tokenizer(tokenizer)
+        except Exception:
+            # any tokenizer the converter cannot handle (e.g. unparsable merges) keeps the per-string path
+            self.backend = None
+            return
+        no_split = getattr(tokenizer, "unique_no_split_tokens", None) or list(tokenizer.added_tokens_encoder)
+        self.special_ids = {token: tokenizer.convert_tokens_to_ids(token) for token in no_split}
+        self.special_strip = {}
+        for token in tokenizer.all_special_tokens_extended:
+            if not isinstance(token, str):
+                self.special_strip[str(token)] = (token.lstrip, token.rstrip)
+        pattern = "|".join(re.escape(token) for token in sorted(self.special_ids, key=len, reverse=True))
+        self.special_re = re.compile("(%s)" % pattern) if pattern else None
+
+    def __len__(self):
+        return len(self.memo)
+
+    def clear(self):
+        self.memo.clear()
+        self.chunks.clear()
+        self.last_history = []
+        self.last_ids = []
+
+    def encode(self, text):
+        ids = self.memo.get(text)
+        if ids is None:
+            self.prime([text])
+            ids = self.memo[text]
+        return ids
+
+    def encode_history(self, history):
+        """ [encode(turn) for turn in history], reusing the ids of the previous call when `history`
+            extends its history, as the consecutive turns of an incar dialogue do, so only the new
+            utterances are encoded. The returned list is shared with the next call, do not modify it.
+        """
+        n = len(self.last_history)
+        if n and len(history) >= n and history[:n] == self.last_history:
+            ids = self.last_ids + [self.encode(turn) for turn in history[n:]]
+        else:
+            ids = [self.encode(turn) for turn in history]
+        self.last_history, self.last_ids = history, ids
+        return ids
+
+    def prime(self, texts):
+        """ Tokenize every string of `texts` that is not memoized yet, batch_size strings per call """
+        unseen = [text for text in dict.fromkeys(texts) if text not in self.memo]
+        for i in range(0, len(unseen), self.batch_size):
+            batch = unseen[i:i + self.batch_size]
+            self.memo.update(zip(batch, self._encode_batch(batch)))
+
+    def _encode_batch(self, texts):
+        if getattr(self.tokenizer, "is_fast", False):
+            return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        if self.backend is None:
+            return [self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(text)) for text in texts]
+
+        pieces = [self._split(text) for text in texts]
+        unseen = list(dict.fromkeys(piece for split in pieces for piece in split
+                                    if piece not in self.special_ids and piece not in self.chunks))
+        for encoding, chunk in zip(self.backend.encode_batch(unseen, add_special_tokens=False), unseen):
+            self.chunks[chunk] = encoding.ids
+        batch_ids = []
+        for split in pieces:
+            ids = []
+            for piece in split:
+                if piece in self.special_ids:
+                    ids.append(self.special_ids[piece])
+                else:
+                    ids.extend(self.chunks[piece])
+            batch_ids.append(ids)
+        return batch_ids
+
+    def _split(self, text):
+        # PreTrainedTokenizer.tokenize: split on the added tokens, strip the text next to them
+        text, _ = self.tokenizer.prepare_for_tokenization(text)
+        if self.special_re is None:
+            return [text] if text else []
+        tokens = self.special_re.split(text)
+        for i, token in enumerate(tokens):
+            if i % 2 == 0:
+                continue
+            lstrip, rstrip = self.special_strip.get(token, (True, True))
+            if rstrip and i + 1 < len(tokens):
+                tokens[i + 1] = tokens[i + 1].lstrip()
+            if lstrip:
+                tokens[i - 1] = tokens[i - 1].rstrip()
+        return [token for token in tokens if token]
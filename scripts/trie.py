@@ -1,5 +1,9 @@
 import os, json
+import hashlib
+from bisect import bisect_left
 from itertools import chain
+import numpy as np
+from .tokenizer_memo import TokenizerMemo
 
 class Trie(object):
     
@@ -37,6 +41,17 @@ class Trie(object):
             data = data[k]
         return [k for k in data if k != self.value_key]
 
+    @property
+    def root(self):
+        return self.data
+
+    def child(self, node, key):
+        # one step of next_ones: the node reached from `node` by `key`, None if the key leaves the trie
+        return node.get(str(key))
+
+    def next_ids(self, node):
+        return [int(k) for k in node if k != self.value_key]
+
     def keys(self, prefix=None, data=None):
        
         data = data or self.data
@@ -62,6 +77,199 @@ class Trie(object):
         with open(filename) as f:
             self.data = json.load(f)
             
+class ArrayTrie(object):
+    """ Read-optimised Trie with int token keys, stored in flat arrays.
+        Nodes are numbered breadth first from the root (0), so the children of node n are the sorted
+        tokens child_tokens[offsets[n]:offsets[n + 1]] and the child reached through child_tokens[i] is
+        node i + 1. value_ids[n] indexes value_list (-1: no value ends at n).
+        Keys set with __setitem__ are buffered and merged into the arrays on the next lookup.
+    """
+
+    def __init__(self, value_key=-1):
+        self.value_key = str(value_key)
+        self.value_list = []
+        self.frozen = False
+        self._pending = []
+        self._set_arrays(np.zeros(2, dtype=np.int32), np.zeros(0, dtype=np.int32), np.full(1, -1, dtype=np.int32))
+
+    def _set_arrays(self, offsets, child_tokens, value_ids):
+        self.offsets, self.child_tokens, self.value_ids = offsets, child_tokens, value_ids
+        # lookups index through memoryviews: plain int reads, no numpy scalar per step
+        self._offsets = memoryview(offsets)
+        self._child_tokens = memoryview(child_tokens)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_offsets"], state["_child_tokens"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_arrays(self.offsets, self.child_tokens, self.value_ids)
+
+    @classmethod
+    def from_trie(cls, trie):
+        array_trie = cls()
+        array_trie.value_key = trie.value_key
+        array_trie._from_dict(trie.data)
+        return array_trie
+
+    def _from_dict(self, data):
+        offsets, child_tokens, value_ids, value_list = [0], [], [], []
+        queue = [data]
+        for node in queue:
+            children = sorted((int(k), child) for k, child in node.items() if k != self.value_key)
+            child_tokens.extend(tok for tok, _ in children)
+            queue.extend(child for _, child in children)
+            offsets.append(len(child_tokens))
+            if self.value_key in node:
+                if node[self.value_key] not in value_list:
+                    value_list.append(node[self.value_key])
+                value_ids.append(value_list.index(node[self.value_key]))
+            else:
+                value_ids.append(-1)
+        self._set_arrays(np.array(offsets, dtype=np.int32), np.array(child_tokens, dtype=np.int32),
+                         np.array(value_ids, dtype=np.int32))
+        self.value_list = value_list
+
+    def _to_dict(self, node=0):
+        data = {}
+        for i in range(self.offsets[node], self.offsets[node + 1]):
+            data[str(self.child_tokens[i])] = self._to_dict(i + 1)
+        if self.value_ids[node] >= 0:
+            data[self.value_key] = self.value_list[self.value_ids[node]]
+        return data
+
+    def _compile(self):
+        trie = Trie()
+        trie.value_key = self.value_key
+        trie.data = self._to_dict()
+        for key, value in self._pending:
+            trie[key] = value
+        self._pending = []
+        self._from_dict(trie.data)
+
+    def __setitem__(self, key, value):
+        if self.frozen:
+            raise TypeError("this ArrayTrie is frozen (shared between examples)")
+        self._pending.append((key, value))
+
+    def freeze(self):
+        if self._pending:
+            self._compile()
+        for array in (self.offsets, self.child_tokens, self.value_ids):
+            array.flags.writeable = False
+        self.frozen = True
+        return self
+
+    def __getitem__(self, key):
+        node = self._walk(key)
+        if node is None or self.value_ids[node] < 0:
+            raise KeyError(key)
+        return self.value_list[self.value_ids[node]]
+
+    @property
+    def root(self):
+        if self._pending:
+            self._compile()
+        return 0
+
+    def child(self, node, key):
+        lo, hi = self._offsets[node], self._offsets[node + 1]
+        i = lo if hi - lo == 1 else bisect_left(self._child_tokens, key, lo, hi)
+        if i < hi and self._child_tokens[i] == key:
+            return i + 1
+        return None
+
+    def next_ids(self, node):
+        return self.child_tokens[self._offsets[node]:self._offsets[node + 1]]
+
+    def _walk(self, prefix):
+        # child() inlined, this is the per-token loop of next_ones / __getitem__
+        node = self.root
+        offsets, child_tokens = self._offsets, self._child_tokens
+        for k in prefix:
+            k = int(k)
+            lo, hi = offsets[node], offsets[node + 1]
+            i = lo if hi - lo == 1 else bisect_left(child_tokens, k, lo, hi)
+            if i == hi or child_tokens[i] != k:
+                return None
+            node = i + 1
+        return node
+
+    def next_ones(self, prefix):
+        node = self._walk(prefix)
+        if node is None:
+            raise KeyError(prefix)
+        return self.next_ids(node)
+
+    def keys(self, prefix=None):
+        prefix = [int(k) for k in prefix or []]
+        node = self._walk(prefix)
+        if node is None:
+            return []
+        results = []
+        stack = [(node, prefix)]
+        while stack:
+            node, key = stack.pop()
+            if self.value_ids[node] >= 0:
+                results.append(key)
+            for i in range(self.offsets[node + 1] - 1, self.offsets[node] - 1, -1):
+                stack.append((i + 1, key + [int(self.child_tokens[i])]))
+        return results
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.child_tokens.nbytes + self.value_ids.nbytes
+
+    def save(self, filename):
+        if self._pending:
+            self._compile()
+        np.savez(filename, offsets=self.offsets, child_tokens=self.child_tokens, value_ids=self.value_ids,
+                 value_list=np.array(json.dumps(self.value_list)))
+
+    def load(self, filename):
+        with np.load(filename) as f:
+            self._set_arrays(f["offsets"], f["child_tokens"], f["value_ids"])
+            self.value_list = json.loads(str(f["value_list"]))
+        self._pending = []
+
+
+class TrieCache(object):
+    """ Content-addressed get_trie: examples with the same KG and key order share one frozen ArrayTrie.
+        Keys hash the KG entities (in sorted order, the trie does not depend on it) and kgsort, so one
+        cache must only serve one tokenizer.
+    """
+
+    def __init__(self):
+        self.tries = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(kgdict, kgsort):
+        canonical = json.dumps([sorted(kgdict.items()), kgsort], ensure_ascii=False)
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def get_trie(self, kgdict, kgsort, tokenizer):
+        key = self.key(kgdict, kgsort)
+        trie = self.tries.get(key)
+        if trie is None:
+            self.misses += 1
+            trie = ArrayTrie.from_trie(get_trie(kgdict, kgsort, Trie(), tokenizer)).freeze()
+            self.tries[key] = trie
+        else:
+            self.hits += 1
+            self.bytes_saved += trie.nbytes
+        return trie
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return "Trie cache: %d/%d hits (%.1f%%), %d unique tries, %.1f KB saved" % (
+            self.hits, lookups, 100.0 * self.hits / max(lookups, 1), len(self.tries), self.bytes_saved / 1024)
+
+
 # kgdict ={'jinling_noodle_bar': [['address', '11_peas_hill_city_centre'], ['area', 'centre'], ['food', 'chinese'], ['phone', '01223_566188'], ['pricerange', 'moderate'], ['postcode', 'cb23pp']], 'lan_hong_house': [['address', '12_norfolk_street_city_centre'], ['area', 'centre'], ['food', 'chinese'], ['phone', '01223_350420'], ['pricerange', 'moderate'], ['postcode', 'cb12lf']], 'golden_wok': [['address', '191_histon_road_chesterton'], ['area', 'north'], ['food', 'chinese'], ['phone', '01223_350688'], ['pricerange', 'moderate'], ['postcode', 'cb43hl']], 'shanghai_family_restaurant': [['address', '39_burleigh_street_city_centre'], ['area', 'centre'], ['food', 'chinese'], ['phone', '01223_301761'], ['pricerange', 'moderate'], ['postcode', 'cb11dg']]}
 kgsort = [['food','area','pricerange','name','address','phone','postcode'],['area','pricerange','food','name','address','phone','postcode'],
           ['area','food','pricerange','name','address','phone','postcode'],['food','pricerange','area','name','address','phone','postcode'],
@@ -70,7 +278,9 @@ incarkgsort = [['poi_type','distance','traffic_info','name','address','time','da
 
 wozkgsort = [['area','pricerange','type','food','stars','choice','name','address','phone','postcode','ref']]
 
-def get_trie(kgdict, kgsort, KG, tokenizer):
+def get_trie_texts(kgdict, kgsort):
+    """ The strings get_trie tokenizes, one per KG entity """
+    texts = []
     ids = []
     tpkg = {}
     for k, v in kgdict.items():
@@ -83,10 +293,19 @@ def get_trie(kgdict, kgsort, KG, tokenizer):
         # print('ids',ids)
         # exit()
         
-        ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(' '.join(ids)))
-        KG[ids] = 50258
+        texts.append(' '.join(ids))
         ids = []
         tpkg = {}
+    return texts
+
+def get_trie(kgdict, kgsort, KG, tokenizer):
+    """ tokenizer can also be a TokenizerMemo """
+    for text in get_trie_texts(kgdict, kgsort):
+        if isinstance(tokenizer, TokenizerMemo):
+            ids = tokenizer.encode(text)
+        else:
+            ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+        KG[ids] = 50258
     return KG
 
 def get_kg_res(kgdict, kgsort):
@@ -99,4 +318,4 @@ def get_kg_res(kgdict, kgsort):
         ids += [[tp, tpkg[tp]] for tp in kgsort[0] if tp in list(tpkg.keys())]
         ids = list(chain(*ids))+["[EKG]"]
         # print(ids)
-    return ids
\ No newline at end of file
+    return ids
\ No newline at end of file
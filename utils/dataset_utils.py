@@ -1,3 +1,10 @@
+from itertools import chain
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+
 def pad_ids(arrays, padding, max_length=-1):
     if max_length < 0:
         max_length = max(list(map(len, arrays)))
@@ -20,3 +27,58 @@ def truncate_sequences(sequences, max_length):
 
     sequences[0] = sequences[0][words_to_cut:]
     return sequences
+
+
+class TensorCollator(object):
+    """ Pads a batch of instances straight into int64 tensors: the ids of all examples are read into
+        one array with np.fromiter and scattered into a [3, B, T] block under the length mask, pos_ids
+        is an arange broadcast over the batch (padding positions keep counting, their labels are -100).
+
+        In the main process the blocks come from a round-robin pool of pool_size flat buffers that grow
+        to the largest batch seen, pinned with pin_memory when CUDA is available, so the tensors of a
+        batch are overwritten pool_size batches later. DataLoader workers send their batches through
+        shared memory, so there every batch gets fresh tensors.
+    """
+
+    def __init__(self, pad, pin_memory=False, pool_size=2):
+        self.pad = pad
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.pool_size = pool_size
+        self.pool = []
+        self.next_slot = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = []
+        state["next_slot"] = 0
+        return state
+
+    def _buffer(self, size):
+        if get_worker_info() is not None:
+            return torch.empty(size, dtype=torch.long)
+        if len(self.pool) < self.pool_size:
+            self.pool.append(torch.empty(0, dtype=torch.long))
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.pool_size
+        if self.pool[slot].numel() < size:
+            self.pool[slot] = torch.empty(size, dtype=torch.long, pin_memory=self.pin_memory)
+        return self.pool[slot][:size]
+
+    def __call__(self, batch):
+        """ (input_ids, token_type_ids, pos_ids, lm_labels), each [B, T] """
+        input_ids = [ins["input_ids"] for ins in batch]
+        token_type_ids = [ins["token_type_ids"] for ins in batch]
+        lm_labels = [ins["lm_labels"] for ins in batch]
+        lengths = torch.tensor([len(ids) for ids in input_ids])
+        batch_size, maxlen = len(batch), int(lengths.max())
+
+        block = self._buffer(4 * batch_size * maxlen).view(4, batch_size, maxlen)
+        positions = torch.arange(maxlen)
+        mask = positions < lengths[:, None]
+        values = np.fromiter(chain(chain.from_iterable(input_ids), chain.from_iterable(token_type_ids),
+                                   chain.from_iterable(lm_labels)), dtype=np.int64, count=3 * int(lengths.sum()))
+        block[:2].fill_(self.pad)
+        block[2].fill_(-100)
+        block[:3].masked_scatter_(mask.expand(3, batch_size, maxlen), torch.from_numpy(values))
+        block[3].copy_(positions.expand(batch_size, maxlen))
+        return block[0], block[1], block[3], block[2]
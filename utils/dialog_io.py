@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import pickle
+
+
+# One JSON object per line and dialogue:
+#   {"id", "kg", "task", "history": [utterances before the first turn],
+#    "turns": [{"user", "response", "ref_ents", "kg_tripe"}, ...]}
+# The history of a turn is not stored: it is the record history followed by the user and system
+# utterances of the earlier turns, so an incar dialogue of n turns holds each utterance once instead
+# of n times as in the .pkl files.
+
+
+def expand_dialogue(record):
+    """ The per-turn dialogs of one record, in the format of the .pkl files from get_pkl """
+    history = list(record["history"])
+    for turn in record["turns"]:
+        history.append(turn["user"])
+        yield {
+            "id": record["id"],
+            "kg": record["kg"],
+            "task": record["task"],
+            "response": turn["response"],
+            "history": list(history),
+            "ref_ents": turn["ref_ents"],
+            "kg_tripe": turn["kg_tripe"],
+        }
+        history.append(turn["response"])
+
+
+def iter_dialogs(path):
+    """ Stream the per-turn dialogs of a .jsonl split, one record in memory at a time """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield from expand_dialogue(json.loads(line))
+
+
+def dialogue_records(dialogs):
+    """ Inverse of expand_dialogue: consecutive per-turn dialogs of the same dialogue whose history
+        continues the previous turn with its response and the new user utterance become one record.
+    """
+    record, previous = None, None
+    for dialog in dialogs:
+        if not dialog["history"]:
+            raise ValueError("dialog %s has an empty history" % dialog["id"])
+        turn = {"user": dialog["history"][-1], "response": dialog["response"],
+                "ref_ents": dialog["ref_ents"], "kg_tripe": dialog["kg_tripe"]}
+        if (record is not None and dialog["id"] == record["id"] and dialog["kg"] == record["kg"]
+                and dialog["task"] == record["task"]
+                and dialog["history"][:-1] == previous["history"] + [previous["response"]]):
+            record["turns"].append(turn)
+        else:
+            if record is not None:
+                yield record
+            record = {"id": dialog["id"], "kg": dialog["kg"], "task": dialog["task"],
+                      "history": dialog["history"][:-1], "turns": [turn]}
+        previous = dialog
+    if record is not None:
+        yield record
+
+
+def write_dialogs(dialogs, path):
+    """ Write per-turn dialogs as a .jsonl split """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in dialogue_records(dialogs):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def dialog_source(dataroot, dataset, split_type):
+    """ The .jsonl split when there is one, else the .pkl written by get_pkl """
+    path = os.path.join(dataroot, dataset, split_type + ".jsonl")
+    if os.path.exists(path):
+        return path
+    return os.path.join(dataroot, dataset, split_type + ".pkl")
+
+
+if __name__ == "__main__":
+    # python -m utils.dialog_io data/incar/train.pkl ...: write train.jsonl next to each .pkl
+    for pkl_path in sys.argv[1:]:
+        with open(pkl_path, "rb") as f:
+            dialogs = pickle.load(f)
+        jsonl_path = os.path.splitext(pkl_path)[0] + ".jsonl"
+        write_dialogs(dialogs, jsonl_path)
+        print("%s: %d dialogs, %d -> %d bytes" % (
+            jsonl_path, len(dialogs), os.path.getsize(pkl_path), os.path.getsize(jsonl_path)))
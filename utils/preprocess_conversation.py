@@ -3,6 +3,8 @@ import pickle
 import ast
 from os.path import join
 from tqdm import tqdm
+from multiprocessing import Pool
+from dialog_io import write_dialogs
 
 
 def knowledge_to_sequence(kg):
@@ -195,53 +197,66 @@ def truncate_long_context(long_text):
     long_text = " ".join(long_text.split()[-400:])
     return long_text
 
-def get_pkl(dataset):
+def format_dialogue(item):
+    """ The pkl entries of one dialogue, item is (dataset, dial_id, dg) """
+    dataset, dial_id, dg = item
+    formatted_dialogues = list()
+    if dataset=="incar":
+        for t,atrun in enumerate(dg["utterances"]):
+            dialog = {}
+            dialog["id"] = dial_id
+            dialog["kg"] = dg["kg"]
+            dialog["task"] = dg["task"]
+            dialog["response"] = atrun["response"]
+
+            if t == 0:
+                dialog["history"] = [atrun["user"]]
+            else:
+                dialog["history"] = formatted_dialogues[-1]["history"] + [dg["utterances"][t-1]["response"],atrun["user"]]
+
+            dialog["ref_ents"] = atrun["reference_entities"]
+            dialog["kg_tripe"] = atrun["kg_tripe"]
+
+
+            formatted_dialogues.append(dialog)
+
+    elif dataset=="camrest" or dataset=="woz2.1":
+        dialog = {}
+        # print(dg)
+        dialog["id"] = dial_id
+        dialog["kg"] = dg["kg"]
+        dialog["task"] = dg["task"]
+        dialog["response"] = dg["response"]
+        dialog["history"] = dg["history"] + [dg["user"]]
+        dialog["ref_ents"] = dg["reference_entities"]
+        if 'kg_tripe' in dg.keys():
+            dialog['kg_tripe'] = dg['kg_tripe']
+        else:
+            dialog['kg_tripe'] = []
+
+        formatted_dialogues.append(dialog)
+    return formatted_dialogues
+
+def get_pkl(dataset, num_workers=1):
     dataroot = "../data/"+dataset
     splits = ["val","test","train"]
     
     for datasplit in splits:
         data = json.load(open(join(dataroot, datasplit+".json")))
         formatted_dialogues = list()
-        previous_id = ""
-        for dial_id, dg in tqdm(data.items(), desc=f"get pkl: {dataset}:{datasplit}::: "):  # only show progress bar in one process
-            current_id = dial_id
-            if dataset=="incar":
-                for t,atrun in enumerate(dg["utterances"]):
-                    dialog = {}
-                    dialog["id"] = dial_id
-                    dialog["kg"] = dg["kg"]
-                    dialog["task"] = dg["task"]
-                    dialog["response"] = atrun["response"]
-
-                    if current_id!=previous_id:
-                        dialog["history"] = [atrun["user"]]
-                    else:
-                        dialog["history"] = formatted_dialogues[-1]["history"] + [dg["utterances"][t-1]["response"],atrun["user"]]
-
-                    dialog["ref_ents"] = atrun["reference_entities"]
-                    dialog["kg_tripe"] = atrun["kg_tripe"]
-
-
-                    formatted_dialogues.append(dialog)
-                    previous_id=current_id
-
-            elif dataset=="camrest" or dataset=="woz2.1":
-                dialog = {}
-                # print(dg)
-                dialog["id"] = dial_id
-                dialog["kg"] = dg["kg"]
-                dialog["task"] = dg["task"]
-                dialog["response"] = dg["response"]
-                dialog["history"] = dg["history"] + [dg["user"]]
-                dialog["ref_ents"] = dg["reference_entities"]
-                if 'kg_tripe' in dg.keys():
-                    dialog['kg_tripe'] = dg['kg_tripe']
-                else:
-                    dialog['kg_tripe'] = []
-
-                formatted_dialogues.append(dialog)
+        items = ((dataset, dial_id, dg) for dial_id, dg in data.items())
+        pool = Pool(num_workers) if num_workers > 1 else None
+        # imap keeps the order of data, so the pkl does not depend on num_workers
+        formatted = pool.imap(format_dialogue, items, chunksize=64) if pool else map(format_dialogue, items)
+        for dialogs in tqdm(formatted, total=len(data), desc=f"get pkl: {dataset}:{datasplit}::: "):  # only show progress bar in one process
+            formatted_dialogues += dialogs
+        if pool:
+            pool.close()
+            pool.join()
 
         pickle.dump(formatted_dialogues, open(join(dataroot, datasplit+".pkl"),"wb"))
+        # same dialogs, one line per dialogue with the history stored once (read by utils/dialog_io.py)
+        write_dialogs(formatted_dialogues, join(dataroot, datasplit+".jsonl"))
 
 
 def process_entities(dataset):
@@ -250,18 +265,18 @@ def process_entities(dataset):
         json.dump(ent_data["all_entities_list"], open(f"../data/{dataset}/entities.json","w"), indent=3)
 
 
-def process_data(dataset="incar"):
+def process_data(dataset="incar", num_workers=1):
     if dataset=="incar":
         process_incar()
-        get_pkl(dataset)
+        get_pkl(dataset, num_workers)
     elif dataset=="camrest":
         process_camrest(dataset=dataset)
         process_entities(dataset=dataset)
-        get_pkl(dataset=dataset)
+        get_pkl(dataset=dataset, num_workers=num_workers)
     elif dataset=="woz2.1":
         process_woz21(dataset=dataset)
         process_entities(dataset=dataset)
-        get_pkl(dataset=dataset)
+        get_pkl(dataset=dataset, num_workers=num_workers)
 
 
 if __name__=="__main__":
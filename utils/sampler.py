@@ -0,0 +1,92 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """ Batch sampler that puts examples of similar length together so little of a batch is padding.
+
+        Every epoch the indices are shuffled, cut into buckets of bucket_size examples and each bucket
+        is sorted by length (examples of the same length stay in shuffled order) and cut into batches;
+        the batches are shuffled again. Batches hold batch_size examples, or with max_tokens as many as
+        fit into max_tokens padded tokens (batch size times the longest example). set_epoch changes the
+        shuffle, report() gives the padding efficiency of the current epoch.
+    """
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, bucket_size=None, shuffle=True,
+                 drop_last=False, seed=0):
+        if (batch_size is None) == (max_tokens is None):
+            raise ValueError("Set exactly one of batch_size and max_tokens")
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        if bucket_size is None:
+            bucket_size = 100 * batch_size if batch_size else 1000
+        if batch_size:
+            # whole batches per bucket, so only the last bucket can end in a short batch
+            bucket_size = max(bucket_size // batch_size, 1) * batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._cached = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _split(self, bucket):
+        if self.batch_size:
+            batches = [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+            if self.drop_last and len(batches[-1]) < self.batch_size:
+                batches.pop()
+            return batches
+        batches, batch, longest = [], [], 0
+        for index in bucket:
+            length = max(longest, self.lengths[index])
+            if batch and length * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, length = [], self.lengths[index]
+            batch.append(index)
+            longest = length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self):
+        """ The batches of the current epoch """
+        if self._cached is not None and self._cached[0] == self.epoch:
+            return self._cached[1]
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            order = list(range(len(self.lengths)))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = sorted(order[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            batches += self._split(bucket)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        self._cached = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+    def padding_efficiency(self, batches=None):
+        """ Real tokens over padded tokens (batch size times longest example) summed over batches """
+        batches = self.batches() if batches is None else batches
+        real = sum(self.lengths[i] for batch in batches for i in batch)
+        padded = sum(len(batch) * max(self.lengths[i] for i in batch) for batch in batches)
+        return real / max(padded, 1)
+
+    def report(self):
+        batches = self.batches()
+        n_examples = sum(len(batch) for batch in batches)
+        return "Epoch %d: %d batches, %.1f examples/batch, padding efficiency %.1f%%" % (
+            self.epoch, len(batches), n_examples / max(len(batches), 1), 100 * self.padding_efficiency(batches))